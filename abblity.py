@@ -1,15 +1,8 @@
-'''
-TODO:
-[ ] 会议室预定算法优化
-    - 思路：
-      1. 将预定时段按每半小时拆分，得到一个时段列表，时段序号为key，时段开始时间、结束时间、是否已预定为value
-      2. 通过全时段的dict.update方法更新已预定的时段
-      3. 创建一个会议室对象，包含会议室名称、容纳人数、时段列表，提供预定方法、取消预定方法、获取可用时段方法
-'''
 
 import datetime
-from functools import wraps
+from functools import wraps, lru_cache
 import time
+import os
 import openai
 import json
 import requests
@@ -34,8 +27,12 @@ YOUDU_DOWNLOAD_DIR = env.str('YOUDU_DOWNLOAD_DIR', './download')
 HEADLESS = True
 WORK_ID = env.str('WORK_ID')
 WORK_PASSWORD = env.str('WORK_PASSWORD')
+OA_COOKIE_FILE = env.str('OA_COOKIE_FILE', './userdata/oa-cookies.json')
+OA_COOKIE_TTL = env.int('OA_COOKIE_TTL', 12 * 60 * 60)
+OA_BOOKING_CACHE_TTL = env.int('OA_BOOKING_CACHE_TTL', 30)
+MEETINGROOM_CONFIG = env.str('MEETINGROOM_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'meetingrooms.json'))
 
-client = app.AppClient(YOUDU_BUIN, YOUDU_APP_ID, YOUDU_AES_KEY, YOUDU_ADDRESS)
+client = app.AsyncAppClient(YOUDU_BUIN, YOUDU_APP_ID, YOUDU_AES_KEY, YOUDU_ADDRESS)
 
 # 写一个输出方法返回值的装饰器，要显示实际调用的方法名
 def print_result(func):
@@ -53,7 +50,9 @@ def current_time():
     return beijing_time.isoformat()
 
 def auto_select_model(messages):
-    tokens = num_tokens(messages)
+    return select_model(num_tokens(messages))
+
+def select_model(tokens):
     print('tokens number is ',tokens)
     if tokens > 16384:
         return "gpt-4-32k"
@@ -63,34 +62,57 @@ def auto_select_model(messages):
         return "gpt-3.5-turbo-0613"
 
 import tiktoken
-def num_tokens(messages, model="gpt-3.5-turbo-0301"):
-    """Returns the number of tokens used by a list of messages."""
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Returns the tiktoken encoding for a model, loaded once per process."""
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
         print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+def token_params(model):
+    """Returns (model, tokens_per_message, tokens_per_name) used for counting."""
     if model == "gpt-3.5-turbo":
         print("Warning: gpt-3.5-turbo may change over time. Returning num tokens assuming gpt-3.5-turbo-0301.")
-        return num_tokens(messages, model="gpt-3.5-turbo-0301")
+        return token_params("gpt-3.5-turbo-0301")
     elif model == "gpt-4":
         print("Warning: gpt-4 may change over time. Returning num tokens assuming gpt-4-0314.")
-        return num_tokens(messages, model="gpt-4-0314")
+        return token_params("gpt-4-0314")
     elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
+        return model, 4, -1  # every message follows <|start|>{role/name}\n{content}<|end|>\n, if there's a name, the role is omitted
     elif model == "gpt-4-0314":
-        tokens_per_message = 3
-        tokens_per_name = 1
+        return model, 3, 1
     else:
         raise NotImplementedError(f"""num_tokens() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
+
+def message_tokens(message, model="gpt-3.5-turbo-0301"):
+    """Returns the number of tokens used by a single message, without the reply priming."""
+    model, tokens_per_message, tokens_per_name = token_params(model)
+    encoding = get_encoding(model)
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        if value is None:
+            continue
+        num_tokens += len(encoding.encode(value if not is_instance(value, dict) else json.dumps(value)))
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+_function_tokens = {}
+def function_tokens(function, model="gpt-3.5-turbo-0301"):
+    """Returns the number of tokens a function schema adds, cached by function name."""
+    key = (function['name'], model)
+    if key not in _function_tokens:
+        _function_tokens[key] = message_tokens(function, model)
+    return _function_tokens[key]
+
+def num_tokens(messages, model="gpt-3.5-turbo-0301"):
+    """Returns the number of tokens used by a list of messages."""
     num_tokens = 0
     for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value if not is_instance(value, dict) else json.dumps(value)))
-            if key == "name":
-                num_tokens += tokens_per_name
+        num_tokens += message_tokens(message, model)
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
@@ -157,8 +179,8 @@ async def get_audit_accounts(user=None):
         raise Exception('user is empty')
     
     _file = auditaccount.run().get('accounts_file')
-    media_id = client.upload_file('xslx', uuid.uuid1(), _file)
-    client.send_msg(Message(
+    media_id = await client.upload_file('xslx', str(uuid.uuid1()), _file)
+    await client.send_msg(Message(
         user, 
         MESSAGE_TYPE_FILE, 
         FileBody(media_id)
@@ -222,28 +244,37 @@ functions.append({
         "required": ["at","name"],
     }
 })
-from playwright.async_api import async_playwright
-import re
+from oa import BrowserLogin, OAClient, BookingCache
+from meetingroom import RoomCatalog, Schedule, time_to_minutes, minutes_to_time
+# 会议室和可预订时段，从 MEETINGROOM_CONFIG 读取，增加会议室只需修改配置
+room_catalog = RoomCatalog.from_file(MEETINGROOM_CONFIG)
+# 浏览器只在 cookie 失效时用于登录，会议室数据通过 HTTP 读取
+oa_client = OAClient(BrowserLogin(WORK_ID, WORK_PASSWORD, headless=HEADLESS), cookie_file=OA_COOKIE_FILE, cookie_ttl=OA_COOKIE_TTL)
+# 按日期缓存会议室预订数据，预订、取消后失效
+booking_cache = BookingCache(lambda date: fetch_meetingroom_info(date), ttl=OA_BOOKING_CACHE_TTL)
 @print_result
 async def book_meetingroom(name, date=time.strftime("%Y-%m-%d", time.localtime()), at=time.strftime("%H:%M", time.localtime()), duration=0.5, theme=None, user=None):
     at = next_30_minute_mark(at)
     
-    data, cookies = await get_meetingroom_info(date)
-    if not data:
+    schedule = await get_meetingroom_info(date)
+    if schedule is None:
         return {
             'message': '抱歉，获取会议室列表失败，请稍后重试'
         }
     
     _end = minutes_to_time(time_to_minutes(at) + int(duration * 60))
-    macther = re.compile(r'.*(\d{4}|贵宾|休闲).*')
-    _name = macther.match(name).group(1) if macther.match(name) is not None else name
+    area = find_room_area(name)
+    if area is None:
+        return {
+            'message': f'抱歉，没有找到会议室{name}'
+        }
+    slots = schedule.slot_range(at, _end)
+    if slots is None:
+        return {
+            'message': f'抱歉，{at}到{_end}不在可预订时段内'
+        }
     
-    booked_room = [
-        booking for booking in data 
-        if macther.match(booking['room_name']).group(1) == _name 
-        and is_time_overlap(at, _end, booking['start'], booking['end'])
-    ]
-    if len(booked_room) > 0:
+    if not schedule.is_free(area, *slots):
         return {
             'message': f'抱歉，{name}在{date} {at}到{date} {_end}已经被预定了，请选择其他时间段或其他会议室'
         }
@@ -251,14 +282,14 @@ async def book_meetingroom(name, date=time.strftime("%Y-%m-%d", time.localtime()
         "meeting_theme": theme or f"{user}的会议",
         "is_video": "0",
         "peopleNum": 2,
-        "timeStart": [k for k, v in enumerate(get_time_slot()) if v['start']==at][0],
-        "timeEnd": [k for k, v in enumerate(get_time_slot()) if v['start']==_end][0],
+        "timeStart": slots[0],
+        "timeEnd": slots[1],
         "user":"",
-        "area": [k for k, v in get_room().items() if macther.match(v['room_name']).group(1) == _name][0],
+        "area": area,
         "day": date
     }
-    response = requests.post('https://oa.addcn.com/Home/Booked/booking', cookies=cookies, data=booking_data)
-    booking_result = response.json()
+    booking_result = await oa_client.post('/Home/Booked/booking', booking_data)
+    booking_cache.invalidate(date)
     
     return {
         'booking_data': {
@@ -272,69 +303,38 @@ async def book_meetingroom(name, date=time.strftime("%Y-%m-%d", time.localtime()
     }
 
 async def get_meetingroom_info(date):
-    playwright = await async_playwright().start()
-    context = await playwright.chromium.launch_persistent_context(headless=HEADLESS, user_data_dir='./userdata', locale='zh-TW')
-    
-    await oa_login(context)
-    _cookies = await context.cookies()
-    cookies = {}
-    for cookie in _cookies:
-        cookies[cookie['name']] = cookie['value']
-    
-    page = await context.new_page()
-    await page.goto(f'https://oa.addcn.com/Home/Booked/index/selectDay/{date}.html')
-    _json = await page.locator('.json-data').first.text_content()
-    await context.close()
-    
-    data = None
-    if _json:
-        data = format_meetingroom_data(json.loads(_json))
+    return await booking_cache.get(date)
+
+# 读取某一天的预订数据，构建会议室占用表
+async def fetch_meetingroom_info(date):
+    _json = await oa_client.get_json_data(f'/Home/Booked/index/selectDay/{date}.html')
     
-    return (data, cookies)
+    if _json is None:
+        return None
+    schedule = Schedule(_json, room_catalog)
+    format_meetingroom_data(_json)
+    return schedule
+
+# 会议室名称对应的会议室 id
+def find_room_area(name):
+    room = room_catalog.find(name)
+    return room.area if room is not None else None
 
 # 下一个30分钟的时间点
 def next_30_minute_mark(time_str):
     minutes = time_to_minutes(time_str)
     return minutes_to_time(minutes + (30 - minutes % 30) % 30)
 
-# 检查时间段是否重叠，参数为字符串，格式为HH:mm
-def is_time_overlap(time1_start, time1_end, time2_start, time2_end):
-    return time_to_minutes(time1_start) < time_to_minutes(time2_end) and time_to_minutes(time1_end) > time_to_minutes(time2_start)
-    
-        
-# 将时间字符串转换成分钟
-def time_to_minutes(time_str):
-    return int(time_str.split(':')[0]) * 60 + int(time_str.split(':')[1])
-
-# 将分钟数转换成时间字符串
-def minutes_to_time(minutes):
-    return f"{str(minutes // 60).zfill(2)}:{str(minutes % 60).zfill(2)}"
-
-async def oa_login(context):
-    page = await context.new_page()
-    await page.goto('https://oa.addcn.com/')
-    if await page.locator('#work_id').count()>0:
-        await page.locator('#work_id').fill(WORK_ID)
-        await page.locator('#pwd').fill(WORK_PASSWORD)
-        await page.locator('#rmbUser').click()
-        await page.get_by_text('登 入').click()
-
 def format_meetingroom_data(data):
-    time_slot = get_time_slot()
-    room = get_room()
+    time_slots = room_catalog.time_slots
     for booking in data:
-        booking['start'] = time_slot[booking['start']]['start']
-        booking['end'] = time_slot[booking['end']]['end']
-        booking['room_name'] = room[booking['area']]['room_name']
-        booking['room_limit'] = room[booking['area']]['room_limit']
-        del booking['area']
+        room = room_catalog.by_area.get(str(booking['area']))
+        booking['start'] = time_slots[booking['start']][0]
+        booking['end'] = time_slots[booking['end']][1]
+        booking['room_name'] = room.name if room is not None else str(booking['area'])
+        booking['room_limit'] = room.capacity if room is not None else 0
     return data
 
-def get_time_slot():
-    return [{"start":"08:30","end":"09:00"},{"start":"09:00","end":"09:30"},{"start":"09:30","end":"10:00"},{"start":"10:00","end":"10:30"},{"start":"10:30","end":"11:00"},{"start":"11:00","end":"11:30"},{"start":"11:30","end":"12:00"},{"start":"12:00","end":"12:30"},{"start":"12:30","end":"13:00"},{"start":"13:00","end":"13:30"},{"start":"13:30","end":"14:00"},{"start":"14:00","end":"14:30"},{"start":"14:30","end":"15:00"},{"start":"15:00","end":"15:30"},{"start":"15:30","end":"16:00"},{"start":"16:00","end":"16:30"},{"start":"16:30","end":"17:00"},{"start":"17:00","end":"17:30"},{"start":"17:30","end":"18:00"},{"start":"18:00","end":"18:30"},{"start":"18:30","end":"19:00"},{"start":"19:00","end":"19:30"},{"start":"19:30","end":"20:00"},{"start":"20:00","end":"20:30"},{"start":"20:30","end":"21:00"},{"start":"21:00","end":"21:30"},{"start":"21:30","end":"22:00"}]        
-
-def get_room():
-    return {"2":{"room_name":"会议室1202","room_limit":6},"3":{"room_name":"会议室1203","room_limit":6},"4":{"room_name":"会议室1204","room_limit":6},"5":{"room_name":"会议1205","room_limit":18},"6":{"room_name":"休闲区12楼","room_limit":9},"7":{"room_name":"会议室1301","room_limit":6},"8":{"room_name":"会议室1302","room_limit":4},"9":{"room_name":"会议室1303","room_limit":6},"10":{"room_name":"会议室1304","room_limit":12},"11":{"room_name":"休闲区13楼","room_limit": 9 },"12":{"room_name":"贵宾室","room_limit":8}}
         
 # https://oa.addcn.com/Home/Booked/delete
 # booked_id=59306
@@ -364,57 +364,76 @@ functions.append({
 })
 @print_result
 async def cancel_meetingroom_booking(name, at, date=current_time(), user=None):
-    macther = re.compile(r'.*(\d{4}|贵宾|休闲).*')
-    _name = macther.match(name).group(1) if macther.match(name) is not None else name
+    area = find_room_area(name)
     
-    data, cookies = await get_meetingroom_info(date)
-    booking = [booking for booking in data if macther.match(booking['room_name']).group(1) == _name and booking['start'] == at]
+    schedule = await get_meetingroom_info(date)
+    bookings = schedule.bookings if schedule is not None else []
+    booking = [booking for booking in bookings if str(booking['area']) == area and booking['start'] == at]
     if len(booking) == 0:
         return '抱歉，没有找到符合条件的会议室预定'
     booked_id = booking[0]['id']
-    response = requests.post('https://oa.addcn.com/Home/Booked/delete', cookies=cookies, data={
+    _json = await oa_client.post('/Home/Booked/delete', {
         "booked_id": booked_id
     })
-    _json = response.json()
+    booking_cache.invalidate(date)
     return {
         'message':_json['msg']
     }
     
 functions.append({
     "name": "get_meetingroom_booking",
-    "description": "get meetingroom booking",
+    "description": "get meetingroom booking and available time, or find free meeting rooms at a given time",
     "parameters": {
         "type": "object",
         "properties": {
             "date": {
                 "type": "string",
                 "description": "booking date, default is today, format is YYYY-MM-DD",
+            },
+            "at": {
+                "type": "string",
+                "description": "find rooms free from this time, format is HH:mm, omit to list all available time of every room",
+            },
+            "duration": {
+                "type": "number",
+                "description": "meeting duration in hours when at is given, step is 0.5 hour, default is 1 hour",
+            },
+            "capacity": {
+                "type": "integer",
+                "description": "minimum number of people the room must hold",
             }
         },
         "required": [],
     }
 })
 @print_result
-async def get_meetingroom_booking(date=current_time(), user=None):
+async def get_meetingroom_booking(date=current_time(), at=None, duration=1, capacity=0, user=None):
     booking_date = date[:10]
-    bookings = await get_meetingroom_info(booking_date)
-    setting_meetingrooms = get_room()
-    setting_booking_timeslots = get_time_slot()
+    schedule = await get_meetingroom_info(booking_date)
+    if schedule is None:
+        return {
+            'message': '抱歉，获取会议室列表失败，请稍后重试'
+        }
     
-    for room in setting_meetingrooms.values():
-        room['bookings'] = [{'start':booking['start'], 'end':booking['end']} for booking in bookings if booking['room_name'] == room['room_name']]
-        room['available_timeslots'] = [timeslot for timeslot in setting_booking_timeslots if not is_time_overlap(timeslot['start'], timeslot['end'], room['bookings'][0]['start'], room['bookings'][0]['end'])]
+    if at:
+        at = next_30_minute_mark(at)
+        _end = minutes_to_time(time_to_minutes(at) + int(duration * 60))
+        slots = schedule.slot_range(at, _end)
+        if slots is None:
+            return {
+                'message': f'抱歉，{at}到{_end}不在可预订时段内'
+            }
+        return {
+            'date': booking_date,
+            'time': f'{at}-{_end}',
+            'free_rooms': [room.to_dict() for room in schedule.free_rooms(*slots, capacity=capacity or 0)]
+        }
     
+    rooms = []
+    for room in room_catalog.with_capacity(capacity or 0):
+        rooms.append(dict(room.to_dict(), available_timeslots=[
+            schedule.window_text(start, end) for start, end in schedule.free_windows(room.area)]))
     return {
-        
+        'date': booking_date,
+        'rooms': rooms
     }
-
-'''
-目前有时段09:00-21:00，时段按每半小时拆分，格式为[{"start":"09:00", "end":"09:30"}]， 写一个方法，传入一个时段的开始和结束时间，计算出与这个时段不重叠的时段列表
-'''
-def get_available_timeslots(timeslots, start, end):
-    available_timeslots = []
-    for timeslot in timeslots:
-        if not is_time_overlap(start, end, timeslot['start'], timeslot['end']):
-            available_timeslots.append(timeslot)
-    return available_timeslots
\ No newline at end of file
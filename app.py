@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import traceback
-from aiohttp import web, ClientSession
+from aiohttp import web, ClientSession, TCPConnector
 from urllib.parse import parse_qsl
 
 import entapp.client as app
@@ -22,6 +23,7 @@ env.read_env()
 for key, value in os.environ.items():
     print(f"{key}={value}")
 
+HOST = env.str('HOST', None)
 PORT = env.int('PORT', 8080)
 RECEIVE_MSG_API = env.str('RECEIVE_MSG_API', '/receive_msg')
 
@@ -31,21 +33,63 @@ YOUDU_AES_KEY = env.str('YOUDU_AES_KEY')
 YOUDU_CALLBACK_TOKEN = env.str('YOUDU_CALLBACK_TOKEN')
 YOUDU_ADDRESS = env.str('YOUDU_ADDRESS', '192.168.8.180:7080')
 YOUDU_DOWNLOAD_DIR = env.str('YOUDU_DOWNLOAD_DIR', './download')
+YOUDU_POOL_SIZE = env.int('YOUDU_POOL_SIZE', 100)
+YOUDU_TOKEN_REFRESH_RATIO = env.float('YOUDU_TOKEN_REFRESH_RATIO', 0.8)
+YOUDU_TOKEN_CACHE_DIR = env.str('YOUDU_TOKEN_CACHE_DIR', None)
 
 OPENAI_EMAIL = env.str('OPENAI_EMAIL')
 OPENAI_PWD = env.str('OPENAI_PWD')
 OPENAI_KEY = env.str('OPENAI_KEY')
 OPENAI_ENGINE = env.str('OPENAI_ENGINE', 'text-davinci-003')
 THINKING_TEXT = env.str('THINKING_TEXT', '思考中...')
+# 超过这么多秒还没有回复时才发送思考中提示
+THINKING_DELAY = env.float('THINKING_DELAY', 2)
 CHATGPT_PROXY = env.str('CHATGPT_PROXY', None)
+# openai 请求共用的连接池
+OPENAI_POOL_SIZE = env.int('OPENAI_POOL_SIZE', 100)
+OPENAI_KEEPALIVE_TIMEOUT = env.int('OPENAI_KEEPALIVE_TIMEOUT', 60)
+OPENAI_DNS_CACHE_TTL = env.int('OPENAI_DNS_CACHE_TTL', 300)
 SESSION_TIMEOUT = env.int('SESSION_TIMEOUT', 60 * 60 * 3)
+# 流式回复：边生成边在句子、段落结束处分段发送
+STREAM_RESPONSE = env.bool('STREAM_RESPONSE', False)
+STREAM_MIN_CHARS = env.int('STREAM_MIN_CHARS', 20)
+STREAM_MAX_CHARS = env.int('STREAM_MAX_CHARS', 800)
+STREAM_MAX_DELAY = env.float('STREAM_MAX_DELAY', 2)
+# 会话存储上限：最多保存的会话数、所有会话的 token 总数（0 为不限制），超出时淘汰最久未使用的会话
+SESSION_MAX_ENTRIES = env.int('SESSION_MAX_ENTRIES', 1000)
+SESSION_MAX_TOKENS = env.int('SESSION_MAX_TOKENS', 0)
+SESSION_SWEEP_INTERVAL = env.int('SESSION_SWEEP_INTERVAL', 60)
+# 会话持久化：为空则只保存在内存中，memory 为进程内存储，sqlite 为 SESSION_DB_PATH 指定的数据库文件
+SESSION_BACKEND = env.str('SESSION_BACKEND', '')
+SESSION_DB_PATH = env.str('SESSION_DB_PATH', './sessions.db')
+SESSION_FLUSH_INTERVAL = env.float('SESSION_FLUSH_INTERVAL', 1)
+STATS_API = env.str('STATS_API', '/stats')
+# 会话上下文 token 预算，超出后把旧对话折叠为摘要，0 为不限制
+CONTEXT_TOKEN_BUDGET = env.int('CONTEXT_TOKEN_BUDGET', 3000)
+CONTEXT_SUMMARY_MODEL = env.str('CONTEXT_SUMMARY_MODEL', 'gpt-3.5-turbo-0613')
+
+# 快速应答模式：回调校验解密后入队即返回，由后台 worker 处理
+FAST_ACK = env.bool('FAST_ACK', False)
+CALLBACK_WORKERS = env.int('CALLBACK_WORKERS', 4)
+CALLBACK_QUEUE_SIZE = env.int('CALLBACK_QUEUE_SIZE', 1000)
+CALLBACK_QUEUE_TIMEOUT = env.float('CALLBACK_QUEUE_TIMEOUT', 1)
+# 对话消息按用户排队：同一用户逐条处理，所有用户同时进行的对话（openai 请求）不超过 OPENAI_CONCURRENCY
+OPENAI_CONCURRENCY = env.int('OPENAI_CONCURRENCY', 8)
+USER_QUEUE_SIZE = env.int('USER_QUEUE_SIZE', 20)
+USER_QUEUE_TOTAL = env.int('USER_QUEUE_TOTAL', 1000)
+# 合并同一用户连续发送的文字消息：最后一条消息之后这么多毫秒内没有新消息才提问，0 为不合并
+COALESCE_WINDOW_MS = env.int('COALESCE_WINDOW_MS', 0)
 
 
 
 """
 接收消息
 """
-client = app.AppClient(YOUDU_BUIN, YOUDU_APP_ID, YOUDU_AES_KEY, YOUDU_ADDRESS)
+# 同一应用的客户端（包括 abblity.client）共用一个 token，由后台提前刷新
+client = app.AsyncAppClient(YOUDU_BUIN, YOUDU_APP_ID, YOUDU_AES_KEY, YOUDU_ADDRESS,
+                            pool_size=YOUDU_POOL_SIZE, refresh_ratio=YOUDU_TOKEN_REFRESH_RATIO,
+                            token_cache_dir=YOUDU_TOKEN_CACHE_DIR)
+crypto = AESCrypto(YOUDU_APP_ID, YOUDU_AES_KEY)
 async def receive_msg(req):
     query_dict = dict(parse_qsl(req.query_string))
     signature = query_dict.get('msg_signature')
@@ -94,45 +138,114 @@ async def receive_msg(req):
         print('buin or appId not match')
         return
 
-    msg_dict = json_loads_utf8(pystr(AESCrypto(YOUDU_APP_ID, YOUDU_AES_KEY).decrypt(encrypt)))
+    msg_dict = json_loads_utf8(pystr(crypto.decrypt_view(encrypt)))
     msg = ReceiveMessage().from_json_object(msg_dict)
     print(str(msg))
 
+    if msg.msg_type not in (MESSAGE_TYPE_IMAGE, MESSAGE_TYPE_FILE) \
+    and not (msg.from_user and msg.create_time > received_time(req) - 15):
+        print('消息已过期，丢弃:', msg.from_user, msg.package_id, msg.create_time)
+        return
+
+    if not FAST_ACK:
+        await handle_msg(msg)
+    elif not await work_queue.put_wait(msg, CALLBACK_QUEUE_TIMEOUT):
+        # 过载时丢弃，不在回调中处理，避免并发失控、回调长时间不返回
+        print('工作队列已满，丢弃消息:', msg.from_user, msg.package_id, work_queue.info())
+
+# 收到回调的时间：多进程模式下 launcher 转发时带上它接收回调的时间，重启期间暂停转发的消息不会因此过期
+def received_time(req):
+    value = req.headers.get('X-Received-At')
+    if value is not None and req.remote in ('127.0.0.1', '::1'):
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return time.time()
+
+async def handle_msg(msg):
     if msg.msg_type == MESSAGE_TYPE_IMAGE:
-        client.download_file(msg.msg_body.to_image_body().media_id, YOUDU_DOWNLOAD_DIR)
+        await client.download_file_stream(msg.msg_body.to_image_body().media_id, YOUDU_DOWNLOAD_DIR)
     elif msg.msg_type == MESSAGE_TYPE_FILE:
-        client.download_file(msg.msg_body.to_file_body().media_id, YOUDU_DOWNLOAD_DIR)
+        await client.download_file_stream(msg.msg_body.to_file_body().media_id, YOUDU_DOWNLOAD_DIR)
+    elif msg.msg_body.content == '/reset' or not COALESCE_WINDOW_MS:
+        # 重置前先提交已合并的消息，保证顺序
+        await coalescer.drain(msg.from_user)
+        await dispatch_user_msg(msg)
+    else:
+        coalescer.put(msg.from_user, msg)
+
+async def dispatch_user_msg(msg):
+    if user_scheduler.put(msg.from_user, msg):
+        return
+    if user_scheduler.full:
+        print('对话队列已满:', msg.from_user, user_scheduler.depth)
+        text = '当前提问的人太多，请稍后再试'
     else:
-        if msg.from_user and msg.create_time > time.time() - 15:
-            if msg.msg_body.content == '/reset':
-                reset_session(msg)
-            else:    
-                await handle_chat(msg)
+        print('用户队列已满:', msg.from_user)
+        text = '消息太多，请等上一个问题回答后再提问'
+    await client.send_msg(Message(msg.from_user, MESSAGE_TYPE_TEXT, TextBody(text)))
+
+# 多条文字消息合并为一条，换行分隔
+def merge_text_msgs(msgs):
+    last = msgs[-1]
+    return ReceiveMessage().from_json_object({
+        'fromUser': last.from_user,
+        'createTime': last.create_time,
+        'packageId': last.package_id,
+        'msgType': MESSAGE_TYPE_TEXT,
+        MESSAGE_TYPE_TEXT: {'content': '\n'.join(msg.msg_body.content for msg in msgs)}
+    })
+
+# 同一用户的对话消息按顺序处理
+async def handle_user_msg(msg):
+    if msg.msg_body.content == '/reset':
+        await reset_session(msg)
+    else:
+        await handle_chat(msg)
+
+from scheduler import WorkQueue, UserScheduler, MessageCoalescer
+work_queue = WorkQueue(handle_msg, workers=CALLBACK_WORKERS, maxsize=CALLBACK_QUEUE_SIZE)
+user_scheduler = UserScheduler(handle_user_msg, concurrency=OPENAI_CONCURRENCY, maxsize=USER_QUEUE_SIZE,
+                               max_total=USER_QUEUE_TOTAL)
+coalescer = MessageCoalescer(dispatch_user_msg, merge_text_msgs, COALESCE_WINDOW_MS / 1000)
 
 async def handle_chat(msg):
-    if THINKING_TEXT:
-        await chatgpt_thinking(msg)
+    use_openai_session()
+    thinking = ThinkingIndicator(msg, THINKING_DELAY) if THINKING_TEXT else None
+
+    # 发送回复前取消还没发出的思考中提示，已经在发送则等它发完，保证提示在回复之前
+    async def reply(text):
+        if thinking is not None:
+            await thinking.settle()
+        await send_text(msg.from_user, text)
+
     try:
         if OPENAI_ENGINE == 'chatgpt' :
-            await chatgpt_api(msg)
+            await chatgpt_api(msg, reply)
         else:
-            await openai_api(msg)
+            await openai_api(msg, reply)
     except Exception as e:
-        alert_user_error(msg, e)
+        if thinking is not None:
+            await thinking.settle()
+        await alert_user_error(msg, e)
         raise e
+    finally:
+        if thinking is not None:
+            await thinking.settle()
                 
-def alert_user_error(msg, e):
-    client.send_msg(Message(
+async def alert_user_error(msg, e):
+    await client.send_msg(Message(
         msg.from_user, 
         MESSAGE_TYPE_TEXT, 
         TextBody('''openai api 发生错误: 
 %s''' %  e))
     )
 
-def reset_session(msg):
+async def reset_session(msg):
     session = UserSession.get(msg.from_user)
     session.reset()
-    client.send_msg(Message(
+    await client.send_msg(Message(
         msg.from_user, 
         MESSAGE_TYPE_TEXT, 
         TextBody('会话已重置，请重新提问'))
@@ -142,12 +255,32 @@ def reset_session(msg):
 chatgpt 思考中的默认回应
 """
 async def chatgpt_thinking(msg):
-    client.send_msg(Message(
+    await client.send_msg(Message(
         msg.from_user, 
         MESSAGE_TYPE_TEXT, 
         TextBody('%s 思考中...' % OPENAI_ENGINE))
     )
 
+class ThinkingIndicator:
+    """
+    delay 秒后还没有回复才发送思考中提示
+    """
+    def __init__(self, msg, delay):
+        self.sending = False
+        self.task = asyncio.create_task(self.run(msg, delay))
+
+    async def run(self, msg, delay):
+        await asyncio.sleep(delay)
+        self.sending = True
+        await chatgpt_thinking(msg)
+
+    async def settle(self):
+        if self.task.done():
+            return
+        if not self.sending:
+            self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
 
 
 """
@@ -155,34 +288,114 @@ openai api 回复
 """
 import openai
 openai.api_key = OPENAI_KEY
-async def openai_api(msg):
-    openai.aiosession.set(ClientSession())
+
+# 所有 openai 请求共用一个长连接的 ClientSession，随服务启动创建、停止关闭
+openai_session = None
+
+async def open_openai_session(app):
+    global openai_session
+    openai_session = ClientSession(connector=TCPConnector(
+        limit=OPENAI_POOL_SIZE,
+        keepalive_timeout=OPENAI_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=OPENAI_DNS_CACHE_TTL))
+    openai.aiosession.set(openai_session)
+
+async def close_openai_session(app):
+    if openai_session is not None:
+        await openai_session.close()
+
+# openai.aiosession 是 ContextVar，只对当前任务生效，在处理消息的任务里设置
+def use_openai_session():
+    if openai_session is not None:
+        openai.aiosession.set(openai_session)
+
+async def openai_api(msg, reply):
     completion = await openai.Completion.acreate(
         engine=OPENAI_ENGINE, 
         prompt=msg.msg_body.content, 
         max_tokens=3000)
-    chatResponse = TextBody(str(completion.choices[0].text).lstrip())
     print(completion)
-    client.send_msg(Message(msg.from_user, MESSAGE_TYPE_TEXT, chatResponse))
-    await openai.aiosession.get().close()
+    await reply(str(completion.choices[0].text).lstrip())
     
 import abblity
 import json
+from conversation import ConversationContext
+from streaming import SentenceBuffer, collect_stream
+
+"""
+把被折叠的旧对话和之前的摘要压缩成新的摘要
+"""
+async def summarize_conversation(summary, messages):
+    lines = []
+    for message in messages:
+        content = message.get('content') or json.dumps(message.get('function_call'), ensure_ascii=False)
+        lines.append(f"{message.get('name') or message['role']}: {content}")
+    prompt = '\n'.join(lines)
+    if summary:
+        prompt = f'之前的摘要：{summary}\n\n新的对话：\n{prompt}'
+    completion = await openai.ChatCompletion.acreate(
+        model=CONTEXT_SUMMARY_MODEL,
+        messages=[
+            {
+                'role':'system',
+                'content':'请用中文把以下对话压缩成简洁的摘要，保留关键事实、用户偏好和未解决的问题，只输出摘要'
+            },
+            {
+                'role':'user',
+                'content':prompt
+            }
+        ]
+    )
+    return completion.choices[0].message.content
+
 class UserSession:
     def __init__(self, user):
         self.user = user
-        self.conversation = [{
-            'role':'user',
-            'content':'无论任何情况下请都使用中文回答问题，除非专业术语不需要翻译'
-        }]
+        # 固定的中文提示语 + 旧对话摘要 + 最近对话，token 数在追加消息时增量计算
+        self.context = ConversationContext(
+            [{
+                'role':'user',
+                'content':'无论任何情况下请都使用中文回答问题，除非专业术语不需要翻译'
+            }],
+            abblity.message_tokens,
+            budget=CONTEXT_TOKEN_BUDGET,
+            summarize=summarize_conversation)
         self.createtime = time.time()
     
-    def auto_select_model(self, messages, functions=None):
-        messages = messages.copy()
-        messages.extend(functions or [])
-        return abblity.auto_select_model(messages)
+    @property
+    def conversation(self):
+        return self.context.messages
+    
+    @property
+    def tokens(self):
+        return self.context.tokens
+    
+    def append(self, message):
+        self.context.append(message)
+        sessions.mark_dirty(self)
+
+    def dump(self):
+        return {
+            'createtime': self.createtime,
+            'context': self.context.dump()
+        }
+
+    def load(self, state):
+        self.createtime = state['createtime']
+        self.context.load(state['context'])
+    
+    def auto_select_model(self, extra_messages=None, functions=None):
+        tokens = self.tokens + 3  # every reply is primed with <|start|>assistant<|message|>
+        tokens += sum(abblity.message_tokens(message) for message in extra_messages or [])
+        tokens += sum(abblity.function_tokens(function) for function in functions or [])
+        return abblity.select_model(tokens)
     
-    async def handle_function(self, question, message):
+    async def stream_completion(self, send, **params):
+        response = await openai.ChatCompletion.acreate(stream=True, **params)
+        buffer = SentenceBuffer(STREAM_MIN_CHARS, STREAM_MAX_CHARS, STREAM_MAX_DELAY)
+        return await collect_stream(response, send, buffer)
+
+    async def handle_function(self, question, message, send=None):
         if message.get("function_call"):
             function_name = message["function_call"]["name"]
 
@@ -207,7 +420,9 @@ class UserSession:
                     "content": json.dumps(function_response),
                 },
             ]
-            model = self.auto_select_model(messages)
+            model = abblity.auto_select_model(messages)
+            if send is not None:
+                return await self.stream_completion(send, model=model, messages=messages)
             second_response = await openai.ChatCompletion.acreate(
                 model=model,
                 messages=messages
@@ -215,52 +430,67 @@ class UserSession:
             return second_response.choices[0].message
         
 
-    async def chat(self, text):
+    async def chat(self, text, send=None):
+        """
+        :param send: 流式回复时发送分段文本的协程函数，为 None 则等待完整回复
+        """
         print('会话[', self.user ,']询问:', text)
-        self.conversation.append({
+        self.append({
             'role':'user',
             'content':text
         })
         self.createtime = time.time()
+        await self.context.fit()
         # 输出timezone +8时间
         beijing_time = abblity.current_time()
-        
-        messages = self.conversation.copy()
-        messages.insert(-1, {
+        time_message = {
             'role':'system',
             'content': f'现在时间是{beijing_time}'
-        })
+        }
+        
+        messages = self.conversation
+        messages.insert(-1, time_message)
         
         functions = FunctionPermission.get(self.user)
         
-        model = self.auto_select_model(messages, functions)
+        model = self.auto_select_model([time_message], functions)
         
         print('model:', model, 'functions:', functions, 'messages:', messages)
         
         # Step 1, send the user's message to the model
-        completion = await openai.ChatCompletion.acreate(
-            model=model,
-            messages= messages,
-            functions=functions,
-            function_call="auto"
-        )
-        print('gpt是否有返回？', completion is None)
+        if send is not None:
+            message = await self.stream_completion(
+                send,
+                model=model,
+                messages= messages,
+                functions=functions,
+                function_call="auto"
+            )
+        else:
+            completion = await openai.ChatCompletion.acreate(
+                model=model,
+                messages= messages,
+                functions=functions,
+                function_call="auto"
+            )
+            print('gpt是否有返回？', completion is None)
+            message = completion.choices[0].message
         
         # Step 2, handle function calls
-        message = completion.choices[0].message
-        message = await self.handle_function(text, message) or message
+        message = await self.handle_function(text, message, send) or message
         
-        self.conversation.append(message.to_dict())
-        print('会话[', self.user ,']回答:', message.content)
-        return message.content
+        self.append(dict(message))
+        print('会话[', self.user ,']回答:', message.get('content'))
+        return message.get('content')
     
     def reset(self):
-        self.conversation = []
+        self.context.reset()
         self.createtime = time.time()
+        sessions.mark_dirty(self)
 
     @classmethod
     def get(cls, user):
-        return SessionCollection.getInstance().get(user)
+        return sessions.get(user)
 
 '''function 权限管理，根据不同用户给出不同权限'''
 class FunctionPermission:
@@ -271,53 +501,40 @@ class FunctionPermission:
             return abblity.functions
         return [func for func in abblity.functions if func['name'] not in need_whitelist]
 
-class SessionCollection(dict):
-    def __init__(self):
-        super().__init__()
-        
-    def get(self, user, default=None):
-        try:
-            if user not in self \
-            or time.time() - self[user].createtime > SESSION_TIMEOUT:
-                print('创建用户:', user)
-                self[user] = UserSession(user)
-                print('创建用户成功', user)
-            
-            return self[user]
-        except Exception:
-            pass
-        
-        return default
-
-    @classmethod
-    def getInstance(cls):
-        if not hasattr(cls, "_instance"):
-            cls._instance = cls()
-        return cls._instance
-    
+from sessions import SessionStore, MemoryBackend, SQLiteBackend
+session_backend = None
+if SESSION_BACKEND == 'sqlite':
+    session_backend = SQLiteBackend(SESSION_DB_PATH)
+elif SESSION_BACKEND == 'memory':
+    session_backend = MemoryBackend()
+elif SESSION_BACKEND:
+    raise ValueError(f'unknown SESSION_BACKEND: {SESSION_BACKEND}')
+sessions = SessionStore(UserSession, SESSION_TIMEOUT,
+                        max_entries=SESSION_MAX_ENTRIES,
+                        max_size=SESSION_MAX_TOKENS,
+                        sizeof=lambda session: session.tokens,
+                        backend=session_backend)
 
 
 """
 chatgpt 回复
 """
-async def chatgpt_api(msg):
+async def send_text(user, text):
+    await client.send_msg(Message(user, MESSAGE_TYPE_TEXT, TextBody(text)))
+
+async def chatgpt_api(msg, reply):
     session = UserSession.get(msg.from_user)
     print(session)
     try:
+        if STREAM_RESPONSE:
+            await session.chat(msg.msg_body.content, send=reply)
+            return
         completion = await session.chat(msg.msg_body.content)
-        client.send_msg(Message(
-            msg.from_user, 
-            MESSAGE_TYPE_TEXT, 
-            TextBody(str(completion).lstrip()))
-        )
+        await reply(str(completion).lstrip())
     except openai.error.OpenAIError as e:
         if str(e).find('maximum context length') > -1:
             session.reset()
-            client.send_msg(Message(
-                msg.from_user, 
-                MESSAGE_TYPE_TEXT, 
-                '会话超过最大token数，已重置会话，请重新提问')
-            )
+            await reply('会话超过最大token数，已重置会话，请重新提问')
         else:
             raise e
 
@@ -328,20 +545,77 @@ from aiohttp.web import middleware
 @middleware
 async def errorHandler(request, handler):
     try:
-        await handler(request)
+        resp = await handler(request)
+        if isinstance(resp, web.StreamResponse):
+            return resp
     except Exception as e:
         print(e)
         traceback.print_exc()
         pass
     return web.json_response({'errcode': 0, 'errmsg': 'ok', 'encrypt': None})
 
+async def start_work_queue(app):
+    if FAST_ACK:
+        work_queue.start()
+    user_scheduler.start()
+
+async def stop_work_queue(app):
+    if FAST_ACK:
+        await work_queue.stop()
+    await coalescer.stop()
+    await user_scheduler.stop()
+
+async def start_sessions(app):
+    sessions.start_sweeper(SESSION_SWEEP_INTERVAL)
+    sessions.start_flusher(SESSION_FLUSH_INTERVAL)
+
+async def close_sessions(app):
+    await sessions.close()
+
+# 运行状态：会话存储命中、淘汰、大小，工作队列长度和丢弃数，用户队列长度和排队等待时间，会议室缓存命中率
+async def stats(req):
+    return web.json_response({
+        'sessions': sessions.info(),
+        'work_queue': work_queue.info(),
+        'user_scheduler': user_scheduler.info(),
+        'coalescer': coalescer.info(),
+        'meetingroom_cache': abblity.booking_cache.info(),
+    })
+
+async def close_clients(app):
+    await client.close()
+    await abblity.client.close()
+
+# 提前准备会议室功能使用的 OA 登录 cookie，缓存失效时才启动浏览器登录，失败时在第一次使用时重试
+async def start_oa_client(app):
+    async def login():
+        try:
+            await abblity.oa_client.cookies()
+        except Exception as e:
+            print('登录 OA 失败:', e)
+    app['oa_login'] = asyncio.create_task(login())
+
+async def stop_oa_client(app):
+    await asyncio.gather(app['oa_login'], return_exceptions=True)
+    await abblity.oa_client.close()
+
 # 创建服务
 def init_server():
     app = web.Application(middlewares=[errorHandler])
     app.router.add_post(RECEIVE_MSG_API, receive_msg)
     app.router.add_get(RECEIVE_MSG_API, receive_msg)
+    app.router.add_get(STATS_API, stats)
+    app.on_startup.append(open_openai_session)
+    app.on_startup.append(start_work_queue)
+    app.on_startup.append(start_sessions)
+    app.on_startup.append(start_oa_client)
+    app.on_cleanup.append(stop_work_queue)
+    app.on_cleanup.append(close_sessions)
+    app.on_cleanup.append(close_clients)
+    app.on_cleanup.append(stop_oa_client)
+    app.on_cleanup.append(close_openai_session)
     return app
 
 
 # 启动服务
-web.run_app(init_server(), port=PORT)
+web.run_app(init_server(), host=HOST, port=PORT)
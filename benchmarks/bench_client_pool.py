@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+"""
+对比 AppClient.send_msg 使用连接池与每次新建连接的吞吐量
+
+    python -m benchmarks.bench_client_pool [消息数]
+"""
+
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.fake_youdu import FakeYouduServer, BUIN, APP_ID, AES_KEY
+from entapp.aes import AESCrypto
+from entapp.client import AppClient
+from entapp.client.api import SCHEME, API_GET_TOKEN, API_SEND_MSG
+from entapp.client.client import _get_token, _send_msg, _url_with_token
+from entapp.message import Message, TextBody, MESSAGE_TYPE_TEXT
+
+
+def bench(name, send, count, threads):
+    msg = Message('benchmark', MESSAGE_TYPE_TEXT, TextBody('hello'))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(lambda i: send(msg), range(count)))
+    elapsed = time.perf_counter() - start
+    print('{name:<10} threads={threads:<3} {count} msgs in {elapsed:.2f}s, {rate:.0f} msg/s'.format(
+        name=name, threads=threads, count=count, elapsed=elapsed, rate=count / elapsed))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    server = FakeYouduServer().start()
+    try:
+        client = AppClient(BUIN, APP_ID, AES_KEY, server.address, pool_size=16)
+        client.send_msg(Message('benchmark', MESSAGE_TYPE_TEXT, TextBody('warmup')))
+        crypto = AESCrypto(APP_ID, AES_KEY)
+        token, _ = _get_token(requests, BUIN, APP_ID, SCHEME + server.address + API_GET_TOKEN, crypto)
+        url = _url_with_token(server.address, API_SEND_MSG, token)
+
+        for threads in (1, 8):
+            bench('unpooled', lambda msg: _send_msg(requests, BUIN, APP_ID, url, crypto, msg), count, threads)
+            bench('pooled', client.send_msg, count, threads)
+        client.close()
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
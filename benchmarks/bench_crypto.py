@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+AESCrypto 加解密微基准，对比复用密钥状态前后的实现
+
+    python -m benchmarks.bench_crypto
+"""
+
+import base64
+import os
+import struct
+import timeit
+
+from Crypto import Random
+from Crypto.Cipher import AES
+
+from benchmarks.fake_youdu import APP_ID, AES_KEY
+from entapp.aes import AESCrypto
+from entapp.utils import *
+
+SIZES = [('1KB', 1024), ('64KB', 64 * 1024), ('8MB', 8 * 1024 * 1024)]
+
+
+def legacy_encrypt(key, app_id, input_data, rand_str=None):
+    """
+    优化前的 _encrypt：每次解码密钥、创建随机数生成器，补位时多次拷贝
+    """
+    rand_str = rand_str or Random.new().read(16)
+    msg_len = struct.pack('!i', len(input_data))
+    padded_key = base64.b64decode(key)
+    aes = AES.new(padded_key, mode=AES.MODE_CBC, IV=rand_str)
+    text = rand_str + msg_len + input_data + bytestr(app_id)
+    padded_text = struct.pack('{n}s'.format(n=(len(text) // 32 + 1) * 32), text)
+    padding_len = 32 - len(text) % 32
+    padded_text = padded_text[0:-padding_len] + struct.pack('b', padding_len) * padding_len
+    return pystr(base64.b64encode(aes.encrypt(padded_text)))
+
+
+def legacy_decrypt(key, app_id, input_string):
+    """
+    优化前的 _decrypt：每次解码密钥并生成随机IV
+    """
+    cipher_text = base64.b64decode(input_string)
+    padded_key = base64.b64decode(key)
+    rand_str = Random.new().read(16)
+    aes = AES.new(padded_key, mode=AES.MODE_CBC, IV=rand_str)
+    text = aes.decrypt(cipher_text)
+    padding_len = text[len(text) - 1]
+    text = text[0:-padding_len]
+    msg_len = struct.unpack('!i', text[16:20])[0]
+    if text[20 + msg_len:] != bytestr(app_id):
+        raise ValueError('unmatched AppID')
+    return text[20:20 + msg_len]
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def main():
+    from entapp.aes.crypto import _encrypt_raw
+
+    crypto = AESCrypto(APP_ID, AES_KEY)
+    rand_str = os.urandom(16)
+    data = os.urandom(64)
+    assert legacy_encrypt(AES_KEY, APP_ID, data, rand_str) == \
+        _encrypt_raw(base64.b64decode(AES_KEY), bytestr(APP_ID), data, rand_str)
+
+    print('{0:>6} {1:>8} {2:>14} {3:>14} {4:>8}'.format('size', 'op', 'legacy us', 'current us', 'speedup'))
+    for name, size in SIZES:
+        data = os.urandom(size)
+        cipher_text = crypto.encrypt(data)
+        number = max(3, 2000000 // size)
+        rows = [
+            ('encrypt', lambda: legacy_encrypt(AES_KEY, APP_ID, data), lambda: crypto.encrypt(data)),
+            ('decrypt', lambda: legacy_decrypt(AES_KEY, APP_ID, cipher_text), lambda: crypto.decrypt(cipher_text)),
+            ('view', lambda: legacy_decrypt(AES_KEY, APP_ID, cipher_text), lambda: crypto.decrypt_view(cipher_text)),
+        ]
+        for op, legacy, current in rows:
+            legacy_time = bench(legacy, number)
+            current_time = bench(current, number)
+            print('{0:>6} {1:>8} {2:>14.1f} {3:>14.1f} {4:>7.2f}x'.format(
+                name, op, legacy_time * 1e6, current_time * 1e6, legacy_time / current_time))
+
+    print()
+    print('{0:>6} {1:>6} {2:>8} {3:>14} {4:>14} {5:>8}'.format(
+        'size', 'count', 'op', 'one by one ms', 'pooled ms', 'speedup'))
+    workers = os.cpu_count() or 1
+    for name, size, count in [('1KB', 1024, 1000), ('64KB', 64 * 1024, 200), ('1MB', 1024 * 1024, 32)]:
+        inputs = [os.urandom(size) for i in range(count)]
+        cipher_texts = crypto.encrypt_many(inputs)
+        assert crypto.decrypt_many(cipher_texts, max_workers=workers) == inputs
+        rows = [
+            ('encrypt', lambda: [crypto.encrypt(d) for d in inputs],
+             lambda: crypto.encrypt_many(inputs, max_workers=workers)),
+            ('decrypt', lambda: [crypto.decrypt(c) for c in cipher_texts],
+             lambda: crypto.decrypt_many(cipher_texts, max_workers=workers)),
+        ]
+        for op, single, batch in rows:
+            single_time = bench(single, 1)
+            batch_time = bench(batch, 1)
+            print('{0:>6} {1:>6} {2:>8} {3:>14.1f} {4:>14.1f} {5:>7.2f}x'.format(
+                name, count, op, single_time * 1e3, batch_time * 1e3, single_time / batch_time))
+    print('max_workers={workers}'.format(workers=workers))
+
+
+if __name__ == '__main__':
+    main()
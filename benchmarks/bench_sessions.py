@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+会话存储基准：预置 10k 个会话后，测量热缓存命中、冷加载和每轮对话写回的延迟
+
+    python -m benchmarks.bench_sessions [sqlite数据库路径]
+"""
+
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+from conversation import ConversationContext
+from sessions import SessionStore, MemoryBackend, SQLiteBackend
+
+SESSIONS = 10000
+TURNS = 10
+ROUNDS = 2000
+
+
+class BenchSession(object):
+    """
+    与 app.UserSession 相同的持久化接口，token 数按字符数估算
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.context = ConversationContext([{'role': 'user', 'content': '请使用中文回答'}],
+                                           lambda message: len(message.get('content') or ''))
+        self.createtime = time.time()
+
+    @property
+    def tokens(self):
+        return self.context.tokens
+
+    def dump(self):
+        return {'createtime': self.createtime, 'context': self.context.dump()}
+
+    def load(self, state):
+        self.createtime = state['createtime']
+        self.context.load(state['context'])
+
+
+def turn(i):
+    return [{'role': 'user', 'content': '会议室怎么预订？第%d轮' % i},
+            {'role': 'assistant', 'content': '请告诉我日期、时间和参会人数，我来帮你查询空闲的会议室。' * 3}]
+
+
+def populate(backend):
+    now = time.time()
+    states = {}
+    for user in range(SESSIONS):
+        session = BenchSession(user)
+        for i in range(TURNS):
+            for message in turn(i):
+                session.context.append(message)
+        session.createtime = now
+        states[user] = session.dump()
+        if len(states) == 1000:
+            backend.save_many(states)
+            states = {}
+    backend.save_many(states)
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] * 1e6
+
+
+async def bench(name, backend):
+    populate(backend)
+    store = SessionStore(BenchSession, 3600, max_entries=1000, backend=backend)
+    users = random.sample(range(SESSIONS), ROUNDS)
+
+    cold, hot, append = [], [], []
+    for user in users:
+        start = time.perf_counter()
+        session = store.get(user)
+        cold.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        store.get(user)
+        hot.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for message in turn(TURNS):
+            session.context.append(message)
+            store.mark_dirty(session)
+        append.append(time.perf_counter() - start)
+
+    # 先写回上面修改过的会话，再模拟后台每秒写回：每批为两次写回之间修改过的会话
+    start = time.perf_counter()
+    count = await store.flush()
+    flush = [(count, (time.perf_counter() - start) / count)]
+    for batch in (1, 10, 100):
+        for user in random.sample(range(SESSIONS), batch):
+            store.mark_dirty(store.get(user))
+        start = time.perf_counter()
+        await store.flush()
+        flush.append((batch, (time.perf_counter() - start) / batch))
+
+    for label, samples in (('cold load', cold), ('hot get', hot), ('turn append', append)):
+        print('{0:>7} {1:>12} p50 {2:>9.1f} us  p99 {3:>9.1f} us'.format(
+            name, label, percentile(samples, 0.5), percentile(samples, 0.99)))
+    for batch, per_turn in flush:
+        print('{0:>7} {1:>12} batch {2:>4}  {3:>9.1f} us/turn'.format(name, 'flush', batch, per_turn * 1e6))
+    print('{0:>7} {1}'.format(name, store.info()))
+    await store.close()
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else None
+    tmp_dir = None
+    if path is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp_dir.name, 'sessions.db')
+
+    random.seed(0)
+    asyncio.run(bench('memory', MemoryBackend()))
+    asyncio.run(bench('sqlite', SQLiteBackend(path)))
+    print('sqlite file size: {0:.1f} MB'.format(os.path.getsize(path) / 1024 / 1024))
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+对比上传文件时一次性加密与流式加密的峰值内存（RSS）
+
+每个文件大小、每种模式在独立子进程中构造 multipart 请求体并完整读出，记录 ru_maxrss
+
+    python -m benchmarks.bench_upload_memory [文件大小MB ...]
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+from requests_toolbelt import MultipartEncoder
+
+from benchmarks.fake_youdu import APP_ID, AES_KEY
+from entapp.aes import AESCrypto
+
+
+def build_encoder(mode, path):
+    crypto = AESCrypto(APP_ID, AES_KEY)
+    f = open(path, 'rb')
+    if mode == 'buffered':
+        body = crypto.encrypt(f.read())
+        f.close()
+    else:
+        body = crypto.encrypt_reader(f, os.fstat(f.fileno()).st_size)
+    return MultipartEncoder(fields={'buin': '1', 'appId': APP_ID, 'encrypt': 'x',
+                                    'file': ('file', body, 'text/plain')})
+
+
+def run_child(mode, path):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    encoder = build_encoder(mode, path)
+    total = 0
+    while True:
+        chunk = encoder.read(64 * 1024)
+        if not chunk:
+            break
+        total += len(chunk)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(total, baseline, peak)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1, 16, 64, 256]
+    print('{0:>8} {1:>10} {2:>14} {3:>14}'.format('size', 'mode', 'peak RSS MB', 'delta MB'))
+    for size in sizes:
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            for i in range(size):
+                f.write(os.urandom(1024 * 1024))
+        try:
+            for mode in ('buffered', 'streaming'):
+                out = subprocess.check_output([sys.executable, '-m', 'benchmarks.bench_upload_memory',
+                                               '--child', mode, path])
+                total, baseline, peak = [int(v) for v in out.split()]
+                print('{0:>6}MB {1:>10} {2:>14.1f} {3:>14.1f}'.format(
+                    size, mode, peak / 1024.0, (peak - baseline) / 1024.0))
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+本地模拟的有度服务器，仅供 benchmark 使用
+"""
+
+import asyncio
+import base64
+import json
+import threading
+
+from aiohttp import web
+
+from entapp.aes import AESCrypto
+from entapp.utils import *
+
+BUIN = 1
+APP_ID = 'benchmark'
+AES_KEY = pystr(base64.b64encode(b'0123456789abcdef0123456789abcdef'))
+
+FILE_NAME = 'benchmark.bin'
+
+
+class FakeYouduServer(object):
+    """
+    在后台线程运行的模拟有度服务器，实现 gettoken、msg/send、media/upload、media/get、media/search
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, file_content=b''):
+        self.host = host
+        self.port = port
+        self.crypto = AESCrypto(APP_ID, AES_KEY)
+        self.file_content = file_content
+        self.token_requests = 0
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    @property
+    def address(self):
+        return '{host}:{port}'.format(host=self.host, port=self.port)
+
+    def _encrypted(self, obj):
+        return web.json_response({'errcode': 0, 'errmsg': 'ok',
+                                  'encrypt': self.crypto.encrypt(bytestr(json.dumps(obj)))})
+
+    async def _get_token(self, request):
+        self.token_requests += 1
+        return self._encrypted({'accessToken': 'benchmark-token', 'expireIn': 7200})
+
+    async def _send_msg(self, request):
+        body = await request.json()
+        self.crypto.decrypt(body['encrypt'])
+        return web.json_response({'errcode': 0, 'errmsg': 'ok'})
+
+    async def _upload_file(self, request):
+        form = await request.post()
+        self.crypto.decrypt(form['encrypt'])
+        size = 0
+        while True:
+            chunk = form['file'].file.read(1 << 16)
+            if not chunk:
+                break
+            size += len(chunk)
+        return self._encrypted({'mediaId': 'media-{size}'.format(size=size)})
+
+    async def _download_file(self, request):
+        headers = {'encrypt': self.crypto.encrypt(bytestr(json.dumps(
+            {'name': FILE_NAME, 'size': len(self.file_content)})))}
+        return web.Response(body=bytestr(self.crypto.encrypt(self.file_content)), headers=headers)
+
+    async def _search_file(self, request):
+        return self._encrypted({'name': FILE_NAME, 'size': len(self.file_content)})
+
+    async def _start(self):
+        app = web.Application(client_max_size=1 << 34)
+        app.router.add_post('/cgi/gettoken', self._get_token)
+        app.router.add_post('/cgi/msg/send', self._send_msg)
+        app.router.add_post('/cgi/media/upload', self._upload_file)
+        app.router.add_post('/cgi/media/get', self._download_file)
+        app.router.add_post('/cgi/media/search', self._search_file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""
+会话上下文管理
+"""
+
+
+class ConversationContext(object):
+    """
+    会话上下文：固定的提示语 + 旧对话的摘要 + 最近对话的滑动窗口
+    token 总数超过预算时，把最早的对话折叠进摘要，摘要只在有新对话被折叠时重新生成
+    """
+
+    def __init__(self, pinned, count_tokens, budget=None, summarize=None, low_water=0.6):
+        """
+        构造函数
+        :param pinned: 固定在最前面、不会被折叠的消息
+        :param count_tokens: 计算单条消息 token 数的函数
+        :param budget: 上下文 token 预算，为 None 或 0 则不限制
+        :param summarize: 生成摘要的协程函数 summarize(旧摘要, 被折叠的消息列表)，为 None 则直接丢弃旧对话
+        :param low_water: 超出预算时折叠到 budget * low_water 以下，避免每轮都生成摘要
+        """
+        self.count_tokens = count_tokens
+        self.budget = budget
+        self.summarize = summarize
+        self.low_water = low_water
+        self.pinned = list(pinned)
+        self.pinned_tokens = sum(count_tokens(message) for message in self.pinned)
+        self.reset()
+
+    def reset(self):
+        self.summary_text = None
+        self.summary = None
+        self.summary_tokens = 0
+        self.turns = []
+        self.turn_tokens = []
+        self.turns_total = 0
+
+    @property
+    def tokens(self):
+        return self.pinned_tokens + self.summary_tokens + self.turns_total
+
+    @property
+    def messages(self):
+        messages = list(self.pinned)
+        if self.summary is not None:
+            messages.append(self.summary)
+        messages.extend(self.turns)
+        return messages
+
+    def append(self, message):
+        count = self.count_tokens(message)
+        self.turns.append(message)
+        self.turn_tokens.append(count)
+        self.turns_total += count
+
+    def set_summary(self, text):
+        self.summary_text = text or None
+        if text:
+            self.summary = {
+                'role': 'system',
+                'content': f'之前对话的摘要：{text}'
+            }
+            self.summary_tokens = self.count_tokens(self.summary)
+        else:
+            self.summary = None
+            self.summary_tokens = 0
+
+    def dump(self):
+        """
+        可序列化的上下文状态，不包含固定的提示语
+        """
+        return {
+            'summary': self.summary_text,
+            'turns': list(self.turns),
+            'turn_tokens': list(self.turn_tokens),
+        }
+
+    def load(self, state):
+        """
+        从 dump() 的结果恢复上下文，保存的 token 数与对话条数不一致时重新计算
+        """
+        self.reset()
+        self.set_summary(state.get('summary'))
+        self.turns = list(state.get('turns') or [])
+        turn_tokens = state.get('turn_tokens')
+        if not turn_tokens or len(turn_tokens) != len(self.turns):
+            turn_tokens = [self.count_tokens(message) for message in self.turns]
+        self.turn_tokens = list(turn_tokens)
+        self.turns_total = sum(self.turn_tokens)
+
+    def _pop_turn(self):
+        self.turns_total -= self.turn_tokens.pop(0)
+        return self.turns.pop(0)
+
+    async def fit(self):
+        """
+        token 超出预算时折叠最早的对话，至少保留最后一条消息，窗口从用户消息开始
+        :return: 是否折叠了对话
+        """
+        if not self.budget or self.tokens <= self.budget:
+            return False
+
+        target = self.budget * self.low_water
+        folded = []
+        while len(self.turns) > 1 and self.tokens > target:
+            folded.append(self._pop_turn())
+        while len(self.turns) > 1 and self.turns[0].get('role') != 'user':
+            folded.append(self._pop_turn())
+        if not folded:
+            return False
+
+        text = None
+        if self.summarize is not None:
+            try:
+                text = await self.summarize(self.summary_text, folded)
+            except Exception as e:
+                print('生成会话摘要失败，丢弃旧对话:', e)
+                text = self.summary_text
+        self.set_summary(text)
+        return True
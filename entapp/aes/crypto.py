@@ -5,8 +5,9 @@
 """
 
 from Crypto.Cipher import AES
-from Crypto import Random
+from concurrent.futures import ThreadPoolExecutor
 import base64
+import os
 import struct
 from entapp.error import AESCryptoError
 
@@ -32,6 +33,9 @@ class AESCrypto(object):
 
         self.__key = pystr(key)
         self.__app_id = pystr(app_id)
+        # 解码后的密钥和AppId字节只计算一次，供每次加解密复用
+        self.__padded_key = base64.b64decode(self.__key)
+        self.__app_id_bytes = bytestr(self.__app_id)
 
     @property
     def key(self):
@@ -60,7 +64,7 @@ class AESCrypto(object):
         :rtype: str
         """
         check_type(input_data, bytes)
-        return _encrypt(self.__key, self.__app_id, input_data)
+        return _encrypt_raw(self.__padded_key, self.__app_id_bytes, input_data)
 
     def decrypt(self, input_string):
         """
@@ -73,11 +77,295 @@ class AESCrypto(object):
         :rtype: bytes
         """
         check_types(input_string, unicode_str(), str)
-        return _decrypt(self.__key, self.__app_id, input_string)
+        return _decrypt_raw(self.__padded_key, self.__app_id_bytes, input_string)
+
+    def encrypt_many(self, inputs, max_workers=None):
+        """
+        批量AES加密，复用已解码的密钥；max_workers大于1时使用线程池并行加密
+        :param inputs: 明文列表
+        :param max_workers: 线程数，为None或1时在当前线程依次加密
+        :return: 密文列表，顺序与inputs一致
+        :except AESCryptoError: 加密失败
+
+        :type inputs: list of bytes
+        :type max_workers: int
+        :rtype: list of str
+        """
+        inputs = list(inputs)
+        for input_data in inputs:
+            check_type(input_data, bytes)
+        return _map(lambda input_data: _encrypt_raw(self.__padded_key, self.__app_id_bytes, input_data),
+                    inputs, max_workers)
+
+    def decrypt_many(self, input_strings, max_workers=None):
+        """
+        批量AES解密，复用已解码的密钥；max_workers大于1时使用线程池并行解密
+        :param input_strings: 密文列表
+        :param max_workers: 线程数，为None或1时在当前线程依次解密
+        :return: 明文列表，顺序与input_strings一致
+        :except AESCryptoError: 解密失败
+
+        :type input_strings: list of unicode or str
+        :type max_workers: int
+        :rtype: list of bytes
+        """
+        input_strings = list(input_strings)
+        for input_string in input_strings:
+            check_types(input_string, unicode_str(), str)
+        return _map(lambda input_string: _decrypt_raw(self.__padded_key, self.__app_id_bytes, input_string),
+                    input_strings, max_workers)
+
+    def decrypt_view(self, input_string, out=None):
+        """
+        AES解密，明文直接解密到缓冲区中，返回指向明文的memoryview，不做额外拷贝
+        :param input_string: 密文，可以直接传入响应的bytes
+        :param out: 用于存放解密结果的缓冲区，长度不小于base64解码后的密文长度，为None则新建
+        :return: 明文
+        :except AESCryptoError: 解密失败
+
+        :type input_string: unicode or str or bytes
+        :type out: bytearray
+        :rtype: memoryview
+        """
+        check_types(input_string, unicode_str(), str, bytes)
+        return _decrypt_view(self.__padded_key, self.__app_id_bytes, input_string, out)
+
+    def encrypt_reader(self, fileobj, size, chunk_size=None):
+        """
+        流式AES加密，返回按块读取、加密并base64编码的只读文件对象，结果与encrypt一致
+        :param fileobj: 明文文件对象（二进制模式）
+        :param size: 明文长度，单位：字节
+        :param chunk_size: 每次从fileobj读取的字节数
+        :return: 密文文件对象
+
+        :type fileobj: file
+        :type size: int
+        :type chunk_size: int
+        :rtype: EncryptReader
+        """
+        check_type(size, int)
+        return EncryptReader(self.__padded_key, self.__app_id_bytes, fileobj, size, chunk_size or DEFAULT_CHUNK_SIZE)
+
+    def decryptor(self):
+        """
+        流式AES解密，分块传入base64编码的密文，逐块返回明文
+        :return: 解密对象
+
+        :rtype: StreamDecryptor
+        """
+        return StreamDecryptor(self.__padded_key, self.__app_id_bytes)
 
 
 __AES_PADDING = 32
 
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# 解密时IV只影响第一个块，即被丢弃的16字节随机串，不需要随机生成
+_ZERO_IV = bytes(AES.block_size)
+
+
+class EncryptReader(object):
+    """
+    流式AES加密的只读文件对象，read返回base64编码后的密文
+    len()返回剩余未读取的字节数，可以直接作为MultipartEncoder的文件字段
+    """
+
+    def __init__(self, padded_key, app_id, fileobj, size, chunk_size=DEFAULT_CHUNK_SIZE, rand_str=None):
+        """
+        构造函数
+        :param padded_key: base64解码后的AES Key
+        :param app_id: AppId
+        :param fileobj: 明文文件对象（二进制模式）
+        :param size: 明文长度，单位：字节
+        :param chunk_size: 每次从fileobj读取的字节数
+        :param rand_str: 16字节随机串，为None则随机生成
+
+        :type padded_key: bytes
+        :type app_id: bytes
+        :type fileobj: file
+        :type size: int
+        :type chunk_size: int
+        :type rand_str: bytes
+        """
+        self.__fileobj = fileobj
+        self.__size = size
+        self.__chunk_size = chunk_size
+        self.__rand_str = rand_str or os.urandom(16)
+        self.__padded_key = padded_key
+        self.__app_id = app_id
+
+        cipher_len = _padded_len(20 + size + len(self.__app_id))
+        self.__remaining = (cipher_len + 2) // 3 * 4
+        self.__buffer = bytearray()
+        self.__chunks = self.__iter_chunks()
+
+    def __len__(self):
+        return self.__remaining
+
+    def __iter_chunks(self):
+        """
+        逐块加密，每次产出一段base64编码后的密文
+        """
+        aes = AES.new(self.__padded_key, mode=AES.MODE_CBC, IV=self.__rand_str)
+        pending = self.__rand_str + struct.pack('!i', self.__size)
+        carry = b''
+        remaining = self.__size
+        while remaining > 0:
+            data = self.__fileobj.read(min(self.__chunk_size, remaining))
+            if not data:
+                raise AESCryptoError('encrypt failed', IOError('file is shorter than {size}'.format(size=self.__size)))
+            remaining -= len(data)
+            pending += data
+            block_len = len(pending) - len(pending) % AES.block_size
+            cipher_text = carry + aes.encrypt(pending[:block_len])
+            pending = pending[block_len:]
+            encode_len = len(cipher_text) - len(cipher_text) % 3
+            carry = cipher_text[encode_len:]
+            yield base64.b64encode(cipher_text[:encode_len])
+
+        text_len = 20 + self.__size + len(self.__app_id)
+        padding_len = _padded_len(text_len) - text_len
+        pending += self.__app_id + struct.pack('b', padding_len) * padding_len
+        yield base64.b64encode(carry + aes.encrypt(pending))
+
+    def read(self, size=-1):
+        """
+        读取base64编码后的密文
+        :param size: 最多读取的字节数，小于0则读取全部
+        :return: 密文，读取完毕返回空bytes
+        :except AESCryptoError: 加密失败
+
+        :type size: int
+        :rtype: bytes
+        """
+        while size < 0 or len(self.__buffer) < size:
+            try:
+                self.__buffer += next(self.__chunks)
+            except StopIteration:
+                break
+        if size < 0 or size > len(self.__buffer):
+            size = len(self.__buffer)
+        data = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        self.__remaining -= len(data)
+        return data
+
+
+class StreamDecryptor(object):
+    """
+    流式AES解密，update传入base64编码的密文片段，返回可以确定的明文，全部传入后调用finalize校验
+    """
+
+    def __init__(self, padded_key, app_id):
+        """
+        构造函数
+        :param padded_key: base64解码后的AES Key
+        :param app_id: AppId
+
+        :type padded_key: bytes
+        :type app_id: bytes
+        """
+        self.__aes = AES.new(padded_key, mode=AES.MODE_CBC, IV=_ZERO_IV)
+        self.__app_id = app_id
+        self.__encoded = bytearray()
+        self.__cipher_text = bytearray()
+        self.__header = bytearray()
+        self.__msg_len = None
+        self.__written = 0
+        self.__trailer = bytearray()
+
+    @property
+    def msg_len(self):
+        """
+        明文长度，解出头部之前为None
+        :rtype: int
+        """
+        return self.__msg_len
+
+    def update(self, data):
+        """
+        传入一段base64编码的密文
+        :param data: 密文片段
+        :return: 本次解出的明文
+        :except AESCryptoError: 解密失败
+
+        :type data: bytes or unicode or str
+        :rtype: bytes
+        """
+        try:
+            self.__encoded += bytestr(data)
+            decode_len = len(self.__encoded) - len(self.__encoded) % 4
+            self.__cipher_text += base64.b64decode(bytes(self.__encoded[:decode_len]))
+            del self.__encoded[:decode_len]
+            return self.__decrypt_blocks()
+        except AESCryptoError:
+            raise
+        except Exception as e:
+            raise AESCryptoError('decrypt failed', e)
+
+    def __decrypt_blocks(self):
+        block_len = len(self.__cipher_text) - len(self.__cipher_text) % AES.block_size
+        if block_len == 0:
+            return b''
+        text = memoryview(self.__aes.decrypt(bytes(self.__cipher_text[:block_len])))
+        del self.__cipher_text[:block_len]
+
+        if self.__msg_len is None:
+            need = 20 - len(self.__header)
+            self.__header += text[:need]
+            text = text[need:]
+            if len(self.__header) < 20:
+                return b''
+            self.__msg_len = struct.unpack('!i', self.__header[16:20])[0]
+
+        payload_len = min(len(text), self.__msg_len - self.__written)
+        self.__written += payload_len
+        self.__trailer += text[payload_len:]
+        return bytes(text[:payload_len])
+
+    def finalize(self):
+        """
+        全部密文传入后校验补位、长度和AppId
+        :except AESCryptoError: 校验失败
+        """
+        if len(self.__encoded) > 0 or len(self.__cipher_text) > 0:
+            raise AESCryptoError('invalid msg')
+        if self.__msg_len is None or self.__written != self.__msg_len or len(self.__trailer) == 0:
+            raise AESCryptoError('invalid msg')
+
+        padding_len = self.__trailer[-1]
+        dest_app_id = bytes(self.__trailer[:-padding_len])
+        if dest_app_id != self.__app_id:
+            raise AESCryptoError('unmatched AppID: {app_id}'.format(app_id=pystr(dest_app_id)))
+
+
+def _map(func, items, max_workers=None):
+    """
+    依次或者用线程池对列表执行func，pycryptodome加解密时会释放GIL
+    :param func: 处理函数
+    :param items: 列表
+    :param max_workers: 线程数，为None或1时在当前线程执行
+    :return: 结果列表，顺序与items一致
+
+    :type func: callable
+    :type items: list
+    :type max_workers: int
+    :rtype: list
+    """
+    if not max_workers or max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def _padded_len(text_len):
+    """
+    补位后的明文长度
+    :param text_len: 补位前的长度
+    :rtype: int
+    """
+    return (text_len // __AES_PADDING + 1) * __AES_PADDING
+
 
 def _encrypt(key, app_id, input_data):
     """
@@ -94,17 +382,37 @@ def _encrypt(key, app_id, input_data):
     :rtype: str
     """
     try:
-        rand_str = Random.new().read(16)
-        msg_len = struct.pack('!i', len(input_data))
         padded_key = base64.b64decode(key)
+        app_id = bytestr(app_id)
+    except Exception as e:
+        raise AESCryptoError("encrypt failed", e)
+    return _encrypt_raw(padded_key, app_id, input_data)
+
+
+def _encrypt_raw(padded_key, app_id, input_data, rand_str=None):
+    """
+    AES加密
+    :param padded_key: base64解码后的AES Key
+    :param app_id: AppId
+    :param input_data: 明文
+    :param rand_str: 16字节随机串，为None则随机生成
+    :return: 密文
+    :except AESCryptoError: 加密失败
+
+    :type padded_key: bytes
+    :type app_id: bytes
+    :type input_data: bytes
+    :type rand_str: bytes
+    :rtype: str
+    """
+    try:
+        rand_str = rand_str or os.urandom(16)
+        text_len = 20 + len(input_data) + len(app_id)
+        padding_len = _padded_len(text_len) - text_len
+        padded_text = b''.join((rand_str, struct.pack('!i', len(input_data)), input_data, app_id,
+                                bytes((padding_len,)) * padding_len))
         aes = AES.new(padded_key, mode=AES.MODE_CBC, IV=rand_str)
-        text = rand_str + msg_len + input_data + bytestr(app_id)
-        padded_text = struct.pack('{n}s'.format(
-            n=(len(text) // __AES_PADDING + 1) * __AES_PADDING), text)
-        padding_len = __AES_PADDING - len(text) % __AES_PADDING
-        padded_text = padded_text[0:-padding_len] + struct.pack('b', padding_len) * padding_len
-        cipher_text = aes.encrypt(padded_text)
-        return pystr(base64.b64encode(cipher_text))
+        return pystr(base64.b64encode(aes.encrypt(padded_text)))
     except Exception as e:
         raise AESCryptoError("encrypt failed", e)
 
@@ -124,15 +432,57 @@ def _decrypt(key, app_id, input_string):
     :rtype: bytes
     """
     try:
-        cipher_text = base64.b64decode(input_string)
         padded_key = base64.b64decode(key)
-        rand_str = Random.new().read(16)
-        aes = AES.new(padded_key, mode=AES.MODE_CBC, IV=rand_str)
-        text = aes.decrypt(cipher_text)
+        app_id = bytestr(app_id)
+    except Exception as e:
+        raise AESCryptoError('decrypt failed', e)
+    return _decrypt_raw(padded_key, app_id, input_string)
+
+
+def _decrypt_raw(padded_key, app_id, input_string):
+    """
+    AES解密
+    :param padded_key: base64解码后的AES Key
+    :param app_id: AppId
+    :param input_string: 密文
+    :return: 明文
+    :except AESCryptoError: 解密失败
+
+    :type padded_key: bytes
+    :type app_id: bytes
+    :type input_string: unicode or str
+    :rtype: bytes
+    """
+    return _decrypt_view(padded_key, app_id, input_string).tobytes()
+
+
+def _decrypt_view(padded_key, app_id, input_string, out=None):
+    """
+    AES解密到缓冲区
+    :param padded_key: base64解码后的AES Key
+    :param app_id: AppId
+    :param input_string: 密文
+    :param out: 用于存放解密结果的缓冲区，为None则新建
+    :return: 指向明文的memoryview
+    :except AESCryptoError: 解密失败
+
+    :type padded_key: bytes
+    :type app_id: bytes
+    :type input_string: unicode or str or bytes
+    :type out: bytearray
+    :rtype: memoryview
+    """
+    try:
+        cipher_text = base64.b64decode(input_string)
+        if out is None:
+            out = bytearray(len(cipher_text))
+        elif len(out) < len(cipher_text):
+            raise AESCryptoError('output buffer is too small')
+        text = memoryview(out)[:len(cipher_text)]
+        aes = AES.new(padded_key, mode=AES.MODE_CBC, IV=_ZERO_IV)
+        aes.decrypt(cipher_text, output=text)
         padding_len = text[len(text) - 1]
-        if isinstance(padding_len, str):
-            padding_len = ord(padding_len)
-        text = text[0:-padding_len]
+        text = text[0:len(text) - padding_len]
         if len(text) <= 20:
             raise AESCryptoError('invalid msg')
 
@@ -141,8 +491,8 @@ def _decrypt(key, app_id, input_string):
             raise AESCryptoError('invalid msg')
 
         dest_app_id = text[20 + msg_len:]
-        if dest_app_id != bytestr(app_id):
-            raise AESCryptoError('unmatched AppID: {app_id}'.format(app_id=pystr(dest_app_id)))
+        if dest_app_id != app_id:
+            raise AESCryptoError('unmatched AppID: {app_id}'.format(app_id=pystr(dest_app_id.tobytes())))
 
         return text[20:20 + msg_len]
     except Exception as e:
@@ -7,3 +7,4 @@
 from .client import FILE_TYPE_FILE
 from .client import FILE_TYPE_IMAGE
 from .client import AppClient
+from .async_client import AsyncAppClient
@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+
+"""
+主动调用接口（asyncio版本）
+"""
+
+import asyncio
+import json
+import os
+import time
+from os.path import join, abspath
+
+import aiohttp
+from requests_toolbelt import MultipartEncoder
+
+from .api import *
+from .token import TokenManager, TokenCache, DEFAULT_REFRESH_RATIO
+from .client import _url_with_token, _parse_err, _parse_file_header, _DecryptFileWriter
+from entapp.aes import AESCrypto
+from entapp.aes.crypto import DEFAULT_CHUNK_SIZE
+from entapp.error import *
+from entapp.message import Message
+from entapp.utils import *
+
+
+class AsyncAppClient(object):
+    """
+    企业应用主动调用接口客户端，所有请求共用一个保持连接的 aiohttp.ClientSession
+    """
+
+    def __init__(self, buin, app_id, aes_key, address, pool_size=100, keepalive_timeout=30, timeout=30,
+                 refresh_ratio=DEFAULT_REFRESH_RATIO, token_cache_dir=None):
+        """
+        构造函数
+        :param buin: 企业总机号
+        :param app_id: AppId
+        :param aes_key: encodingaeskey
+        :param address: 有度服务器地址（IP:PORT）
+        :param pool_size: 连接池大小
+        :param keepalive_timeout: 空闲连接保持时间，单位：秒
+        :param timeout: 建立连接、两次读取之间的超时时间，单位：秒；不限制请求总时长，大文件上传下载不会被中断
+        :param refresh_ratio: 在token的expireIn的多少比例时提前刷新，同一应用的客户端共用token
+        :param token_cache_dir: token磁盘缓存目录，为None则不缓存
+
+        :type buin: int
+        :type app_id: unicode or str
+        :type aes_key: unicode or str
+        :type address: unicode or str
+        :type pool_size: int
+        :type keepalive_timeout: int or float
+        :type timeout: int or float
+        :type refresh_ratio: float
+        :type token_cache_dir: str
+        """
+        check_type(buin, int)
+        check_types(app_id, unicode_str(), str)
+        check_types(aes_key, unicode_str(), str)
+        check_types(address, unicode_str(), str)
+        self.__buin = buin
+        self.__app_id = pystr(app_id)
+        self.__address = pystr(address)
+        self.__crypto = AESCrypto(app_id, aes_key)
+        token_cache = TokenCache(token_cache_dir, self.__crypto) if token_cache_dir else None
+        self.__token_manager = TokenManager.get_instance(
+            self.__buin, self.__app_id, self.__address, refresh_ratio, token_cache)
+        self.__pool_size = pool_size
+        self.__keepalive_timeout = keepalive_timeout
+        self.__timeout = timeout
+        self.__session = None
+
+    @property
+    def buin(self):
+        """
+        企业总机号
+        :rtype: int
+        """
+        return self.__buin
+
+    @property
+    def app_id(self):
+        """
+        AppId
+        :rtype: str
+        """
+        return self.__app_id
+
+    @property
+    def address(self):
+        """
+        有度服务器地址（IP:PORT）
+        :rtype: str
+        """
+        return self.__address
+
+    @property
+    def session(self):
+        """
+        共用的 ClientSession，第一次使用时在当前事件循环中创建
+        :rtype: aiohttp.ClientSession
+        """
+        if self.__session is None or self.__session.closed:
+            connector = aiohttp.TCPConnector(limit=self.__pool_size, keepalive_timeout=self.__keepalive_timeout)
+            self.__session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.__timeout, sock_read=self.__timeout))
+        return self.__session
+
+    async def close(self):
+        """
+        关闭连接池，同时取消token的后台刷新
+        """
+        self.__token_manager.cancel_refresh()
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+        self.__session = None
+
+    async def __access_token(self):
+        """
+        获取accessToken，由同一应用共用的TokenManager负责刷新
+        """
+        return await self.__token_manager.async_token(self.__fetch_token)
+
+    async def __fetch_token(self):
+        """
+        请求新的accessToken
+        """
+        token_url = '{scheme}{address}{uri}'.format(
+            scheme=SCHEME, address=self.__address, uri=API_GET_TOKEN)
+        return await _get_token(self.session, self.__buin, self.__app_id, token_url, self.__crypto)
+
+    async def send_msg(self, msg):
+        """
+        发送消息
+        :param msg: 消息对象
+        :except AESCryptoError: 加密失败
+        :except ParamParserError: 参数解析错误
+        :except HttpRequestError: http请求错误
+
+        :type msg: Message
+        """
+        check_type(msg, Message)
+        url = _url_with_token(self.__address, API_SEND_MSG, await self.__access_token())
+        await _send_msg(self.session, self.__buin, self.__app_id, url, self.__crypto, msg)
+
+    async def upload_file(self, file_type, file_name, file_path):
+        """
+        上传文件
+        :param file_type: 文件类型
+        :param file_name: 文件名称
+        :param file_path: 文件路径
+        :return: 资源Id
+        :except AESCryptoError: 加密失败
+        :except ParamParserError: 参数解析错误
+        :except HttpRequestError: http请求错误
+        :except FileIOError: 读文件错误
+
+        :type file_type: str
+        :type file_name: unicode or str
+        :type file_path: unicode or str
+        :rtype: str
+        """
+        check_type(file_type, str)
+        check_types(file_name, unicode_str(), str)
+        check_types(file_path, unicode_str(), str)
+        url = _url_with_token(self.__address, API_UPLOAD_FILE, await self.__access_token())
+        return await _upload_file(self.session, self.__buin, self.__app_id, url, self.__crypto,
+                                  file_type, pystr(file_name), pystr(file_path))
+
+    async def download_file(self, media_id, out_dir):
+        """
+        下载文件
+        :param media_id: 资源Id
+        :param out_dir: 输出文件的目录
+        :return: (name: 文件名称, size: 文件大小，单位：字节, content: 文件内容)
+        :except AESCryptoError: 加密失败
+        :except ParamParserError: 参数解析错误
+        :except HttpRequestError: http请求错误
+        :except FileIOError: 写文件错误
+
+        :type media_id: unicode or str
+        :type out_dir: unicode or str
+        :rtype: (str, int, bytes)
+        """
+        check_types(media_id, unicode_str(), str)
+        check_types(out_dir, unicode_str(), str)
+        url = _url_with_token(self.__address, API_DOWNLOAD_FILE, await self.__access_token())
+        return await _download_file(self.session, self.__buin, self.__app_id, url, self.__crypto,
+                                    pystr(media_id), pystr(out_dir))
+
+    async def download_file_stream(self, media_id, out_dir):
+        """
+        流式下载文件，分块解密写入临时文件后重命名，不在内存中保留文件内容
+        :param media_id: 资源Id
+        :param out_dir: 输出文件的目录
+        :return: (path: 文件路径, size: 文件大小，单位：字节)
+        :except AESCryptoError: 解密失败
+        :except ParamParserError: 参数解析错误
+        :except HttpRequestError: http请求错误
+        :except FileIOError: 写文件错误
+
+        :type media_id: unicode or str
+        :type out_dir: unicode or str
+        :rtype: (str, int)
+        """
+        check_types(media_id, unicode_str(), str)
+        check_types(out_dir, unicode_str(), str)
+        url = _url_with_token(self.__address, API_DOWNLOAD_FILE, await self.__access_token())
+        return await _download_file_stream(self.session, self.__buin, self.__app_id, url, self.__crypto,
+                                           pystr(media_id), pystr(out_dir))
+
+    async def search_file(self, media_id):
+        """
+        搜索文件信息
+        :param media_id: 资源Id
+        :return: (文件名, 字节数大小)
+        :except AESCryptoError: 加密失败
+        :except ParamParserError: 参数解析错误
+        :except HttpRequestError: http请求错误
+
+        :type media_id: unicode or str
+        :rtype: (str, int)
+        """
+        check_types(media_id, unicode_str(), str)
+        url = _url_with_token(self.__address, API_SEARCHE_FILE, await self.__access_token())
+        return await _search_file(self.session, self.__buin, self.__app_id, url, self.__crypto, pystr(media_id))
+
+
+def _parse_status(rsp):
+    """
+    解析接口错误码
+    :param rsp: aiohttp返回的请求结果
+    :except HttpRequestError: 失败则抛出异常
+    """
+    if rsp.status != 200:
+        try:
+            rsp.raise_for_status()
+        except aiohttp.ClientResponseError as e:
+            raise HttpRequestError(rsp.status, 'request failed', e)
+
+
+async def _iter_read(fileobj, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    在线程池中分块读取文件对象，避免加密阻塞事件循环
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, fileobj.read, chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def _read_json(rsp):
+    """
+    读取并解析json，忽略Content-Type
+    :except ValueError: 解析失败
+    """
+    return json.loads(await rsp.read())
+
+
+async def _get_token(session, buin, app_id, url, crypto_obj):
+    """
+    获取accessToken
+    :param session: aiohttp会话
+    :param buin: 企业总机号
+    :param app_id: AppId
+    :param url: 请求url
+    :param crypto_obj: 加密对象
+    :return: (token: accessToken, expire_in: 留存时间，单位：秒)
+    :except AESCryptoError: 加密失败
+    :except ParamParserError: 参数解析错误
+    :except HttpRequestError: http请求错误
+
+    :type session: aiohttp.ClientSession
+    :type buin: int
+    :type app_id: str
+    :type url: str
+    :type crypto_obj: AESCrypto
+    :rtype: (str, int)
+    """
+    cipher_text = crypto_obj.encrypt(bytestr(str(int(time.time()))))
+    param = {'buin': buin, 'appId': app_id, 'encrypt': cipher_text}
+    json_result = dict()
+    try:
+        async with session.post(url, json=param) as rsp:
+            _parse_status(rsp)
+            json_result = await _read_json(rsp)
+            _parse_err(json_result)
+    except aiohttp.ClientError as e:
+        raise HttpRequestError(0, 'connect failed', e)
+    except ValueError as e:
+        raise ParamParserError('failed to decode json', e)
+
+    encrypt_string = json_result.get('encrypt')
+    if not is_instance(encrypt_string, unicode_str(), str):
+        raise ParamParserError('encrypt content not exists')
+
+    try:
+        token_info = json_loads_utf8(pystr(crypto_obj.decrypt_view(encrypt_string)))
+        token = token_info.get('accessToken')
+        expire_in = token_info.get('expireIn')
+        if not is_instance(token, unicode_str(), str) and not isinstance(expire_in, int):
+            raise ParamParserError('accessToken or expireIn not exists')
+
+        return pystr(token), expire_in
+    except ValueError as e:
+        raise ParamParserError('parse json failed ', e)
+
+
+async def _send_msg(session, buin, app_id, url, crypto_obj, msg):
+    """
+    发送消息
+    :param session: aiohttp会话
+    :param buin: 企业总机号
+    :param app_id: AppId
+    :param url: 带token的请求URL
+    :param crypto_obj: 加密对象
+    :param msg: Message消息对象
+    :except AESCryptoError: 加密失败
+    :except ParamParserError: 参数解析错误
+    :except HttpRequestError: http请求错误
+
+    :type session: aiohttp.ClientSession
+    :type buin: int
+    :type app_id: str
+    :type url: str
+    :type crypto_obj: AESCrypto
+    :type msg: Message
+    """
+    cipher_text = crypto_obj.encrypt(bytestr(msg.to_json_string()))
+    param = {'buin': buin, 'appId': app_id, 'encrypt': cipher_text}
+    try:
+        async with session.post(url, json=param) as rsp:
+            _parse_status(rsp)
+            _parse_err(await _read_json(rsp))
+    except aiohttp.ClientError as e:
+        raise HttpRequestError(0, 'connect failed', e)
+    except ValueError as e:
+        raise ParamParserError('failed to decode json', e)
+
+
+async def _upload_file(session, buin, app_id, url, crypto_obj, file_type, file_name, file_path):
+    """
+    上传文件
+    :param session: aiohttp会话
+    :param buin: 企业总机号
+    :param app_id: AppId
+    :param url: 带token的请求URL
+    :param crypto_obj: 加密对象
+    :param file_type: 文件类型
+    :param file_name: 文件名称
+    :param file_path: 文件路径
+    :return: 资源Id
+    :except AESCryptoError: 加密失败
+    :except ParamParserError: 参数解析错误
+    :except HttpRequestError: http请求错误
+    :except FileIOError: 读文件错误
+
+    :type session: aiohttp.ClientSession
+    :type buin: int
+    :type app_id: str
+    :type url: str
+    :type crypto_obj: AESCrypto
+    :type file_type: str
+    :type file_name: str
+    :type file_path: str
+    :rtype: str
+    """
+    cipher_request = crypto_obj.encrypt(bytestr(json.dumps({'type': file_type, 'name': file_name})))
+    try:
+        f = open(file_path, 'rb')
+        file_size = os.fstat(f.fileno()).st_size
+    except (IOError, OSError) as e:
+        raise FileIOError('failed to read from file {path}'.format(path=file_path), e)
+
+    with f:
+        # 边读边加密，内存占用与文件大小无关；长度已知，不使用chunked编码
+        encoder = MultipartEncoder(
+            fields={'buin': str(buin),
+                    'appId': app_id,
+                    'encrypt': cipher_request,
+                    'file': ('file', crypto_obj.encrypt_reader(f, file_size), 'text/plain')}
+        )
+        headers = {'Content-Type': encoder.content_type, 'Content-Length': str(encoder.len)}
+
+        try:
+            async with session.post(url, data=_iter_read(encoder), headers=headers) as rsp:
+                _parse_status(rsp)
+                json_result = await _read_json(rsp)
+            _parse_err(json_result)
+            cipher_id = json_result.get('encrypt')
+            if not is_instance(cipher_id, unicode_str(), str):
+                raise ParamParserError('encrypt content not exists')
+
+            media_id = json_loads_utf8(pystr(crypto_obj.decrypt_view(cipher_id))).get('mediaId', '')
+            if not is_instance(media_id, unicode_str(), str):
+                raise ParamParserError('result invalid')
+
+            return pystr(media_id)
+        except aiohttp.ClientError as e:
+            raise HttpRequestError(0, 'connect failed', e)
+        except ValueError as e:
+            raise ParamParserError('failed to decode json', e)
+
+
+async def _download_file(session, buin, app_id, url, crypto_obj, media_id, out_dir):
+    """
+    下载文件
+    :param session: aiohttp会话
+    :param buin: 企业总机号
+    :param app_id: AppId
+    :param url: 带token的请求URL
+    :param crypto_obj: 加密对象
+    :param media_id: 资源Id
+    :param out_dir: 输出文件的目录
+    :return: (name: 文件名称, size: 文件大小，单位：字节, content: 文件内容)
+    :except AESCryptoError: 加密失败
+    :except ParamParserError: 参数解析错误
+    :except HttpRequestError: http请求错误
+    :except FileIOError: 写文件错误
+
+    :type session: aiohttp.ClientSession
+    :type buin: int
+    :type app_id: str
+    :type url: str
+    :type crypto_obj: AESCrypto
+    :type media_id: str
+    :type out_dir: str
+    :rtype: (str, int, bytes)
+    """
+    cipher_id = crypto_obj.encrypt(bytestr(json.dumps({'mediaId': media_id})))
+    param = {'buin': buin, 'appId': app_id, 'encrypt': cipher_id}
+    try:
+        async with session.post(url, json=param) as rsp:
+            _parse_status(rsp)
+            content = await rsp.read()
+            cipher_info = rsp.headers.get('encrypt')
+        json_result = None
+        try:
+            json_result = json.loads(content)
+        except ValueError:
+            pass  # 成功的时候不存在JSON数据
+        if not isinstance(json_result, dict):
+            json_result = {'errcode': 0, 'errmsg': ''}
+        _parse_err(json_result)
+        if not is_instance(cipher_info, unicode_str(), str):
+            raise ParamParserError('encrypt content not exists')
+
+        file_info = json_loads_utf8(pystr(crypto_obj.decrypt_view(cipher_info)))
+        file_name = file_info.get('name')
+        file_size = file_info.get('size')
+        if not is_instance(file_name, unicode_str(), str) and isinstance(file_size, int):
+            raise ParamParserError('name or size not exists')
+
+        file_content = crypto_obj.decrypt_view(content)
+        with open(abspath(join(out_dir, pystr(file_name))), 'wb') as f:
+            f.write(file_content)
+
+        return pystr(file_name), file_size, file_content.tobytes()
+
+    except aiohttp.ClientError as e:
+        raise HttpRequestError(0, 'connect failed', e)
+    except ValueError as e:
+        raise ParamParserError('failed to decode json', e)
+    except IOError as e:
+        raise FileIOError('failed to save file to {path}'.format(path=out_dir), e)
+
+
+async def _download_file_stream(session, buin, app_id, url, crypto_obj, media_id, out_dir):
+    """
+    流式下载文件，解密和写文件在线程池中执行
+    :param session: aiohttp会话
+    :param buin: 企业总机号
+    :param app_id: AppId
+    :param url: 带token的请求URL
+    :param crypto_obj: 加密对象
+    :param media_id: 资源Id
+    :param out_dir: 输出文件的目录
+    :return: (path: 文件路径, size: 文件大小，单位：字节)
+    :except AESCryptoError: 解密失败
+    :except ParamParserError: 参数解析错误
+    :except HttpRequestError: http请求错误
+    :except FileIOError: 写文件错误
+
+    :type session: aiohttp.ClientSession
+    :type buin: int
+    :type app_id: str
+    :type url: str
+    :type crypto_obj: AESCrypto
+    :type media_id: str
+    :type out_dir: str
+    :rtype: (str, int)
+    """
+    cipher_id = crypto_obj.encrypt(bytestr(json.dumps({'mediaId': media_id})))
+    param = {'buin': buin, 'appId': app_id, 'encrypt': cipher_id}
+    loop = asyncio.get_running_loop()
+    try:
+        async with session.post(url, json=param) as rsp:
+            _parse_status(rsp)
+            error_body = None
+            if 'encrypt' not in rsp.headers:
+                error_body = await rsp.read()
+            file_name = _parse_file_header(rsp.headers, crypto_obj, lambda: json.loads(error_body))
+
+            writer = await loop.run_in_executor(None, _DecryptFileWriter, crypto_obj, out_dir, file_name)
+            try:
+                async for chunk in rsp.content.iter_chunked(DEFAULT_CHUNK_SIZE):
+                    await loop.run_in_executor(None, writer.write, chunk)
+                await loop.run_in_executor(None, writer.commit)
+            except BaseException:
+                writer.abort()
+                raise
+
+            return writer.path, writer.size
+    except aiohttp.ClientError as e:
+        raise HttpRequestError(0, 'connect failed', e)
+    except ValueError as e:
+        raise ParamParserError('failed to decode json', e)
+
+
+async def _search_file(session, buin, app_id, url, crypto_obj, media_id):
+    """
+    搜索文件信息
+    :param session: aiohttp会话
+    :param buin: 企业总机号
+    :param app_id: AppId
+    :param url: 带token的请求URL
+    :param crypto_obj: 加密对象
+    :param media_id: 资源Id
+    :return: (文件名, 字节数大小)
+    :except AESCryptoError: 加密失败
+    :except ParamParserError: 参数解析错误
+    :except HttpRequestError: http请求错误
+
+    :type session: aiohttp.ClientSession
+    :type buin: int
+    :type app_id: str
+    :type url: str
+    :type crypto_obj: AESCrypto
+    :type media_id: str
+    :rtype: (str, int)
+    """
+    cipher_id = crypto_obj.encrypt(bytestr(json.dumps({'mediaId': media_id})))
+    param = {'buin': buin, 'appId': app_id, 'encrypt': cipher_id}
+    try:
+        async with session.post(url, json=param) as rsp:
+            _parse_status(rsp)
+            json_result = await _read_json(rsp)
+        _parse_err(json_result)
+        encrypt_result = json_result.get('encrypt')
+        if not is_instance(encrypt_result, unicode_str(), str):
+            raise ParamParserError('encrypt content not exists')
+
+        file_info = json_loads_utf8(pystr(crypto_obj.decrypt_view(encrypt_result)))
+        name = file_info.get('name', '')
+        size = file_info.get('size', 0)
+        if name == '' or size <= 0:
+            raise ParamParserError('file info is not valid')
+
+        return name, size
+    except aiohttp.ClientError as e:
+        raise HttpRequestError(0, 'connect failed', e)
+    except ValueError as e:
+        raise ParamParserError('failed to decode json', e)
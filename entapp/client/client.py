@@ -5,14 +5,20 @@
 """
 
 import json
+import os
+import tempfile
 import time
 from os.path import join, abspath
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
 
 from .api import *
+from .token import TokenManager, TokenCache, DEFAULT_REFRESH_RATIO
 from entapp.aes import AESCrypto
+from entapp.aes.crypto import DEFAULT_CHUNK_SIZE
 from entapp.error import *
 from entapp.message import Message
 from entapp.utils import *
@@ -27,18 +33,29 @@ class AppClient(object):
     企业应用主动调用接口客户端
     """
 
-    def __init__(self, buin, app_id, aes_key, address):
+    def __init__(self, buin, app_id, aes_key, address, pool_size=10, max_retries=3, timeout=(5, 30),
+                 refresh_ratio=DEFAULT_REFRESH_RATIO, token_cache_dir=None):
         """
         构造函数
         :param buin: 企业总机号
         :param app_id: AppId
         :param aes_key: encodingaeskey
         :param address: 有度服务器地址（IP:PORT）
+        :param pool_size: 连接池大小
+        :param max_retries: 建立连接失败时的重试次数
+        :param timeout: 请求超时时间，单位：秒，可以是(连接超时, 读取超时)
+        :param refresh_ratio: 在token的expireIn的多少比例时提前刷新，同一应用的客户端共用token
+        :param token_cache_dir: token磁盘缓存目录，为None则不缓存
 
         :type buin: int
         :type app_id: unicode or str
         :type aes_key: unicode or str
         :type address: unicode or str
+        :type pool_size: int
+        :type max_retries: int
+        :type timeout: int or float or tuple
+        :type refresh_ratio: float
+        :type token_cache_dir: str
         """
         check_type(buin, int)
         check_types(app_id, unicode_str(), str)
@@ -48,7 +65,10 @@ class AppClient(object):
         self.__app_id = pystr(app_id)
         self.__address = pystr(address)
         self.__crypto = AESCrypto(app_id, aes_key)
-        self.__token_info = None
+        token_cache = TokenCache(token_cache_dir, self.__crypto) if token_cache_dir else None
+        self.__token_manager = TokenManager.get_instance(
+            self.__buin, self.__app_id, self.__address, refresh_ratio, token_cache)
+        self.__session = _new_session(pool_size, max_retries, timeout)
 
     @property
     def buin(self):
@@ -74,16 +94,26 @@ class AppClient(object):
         """
         return self.__address
 
-    def __check_and_refresh_token(self):
+    def close(self):
         """
-        检查token，不存在或者过期则取获取一次token
+        关闭连接池，同时取消token的后台刷新
         """
-        now = int(time.time())
-        if self.__token_info is None or self.__token_info[1] + self.__token_info[2] < now:
-            token_url = '{scheme}{address}{uri}'.format(
-                scheme=SCHEME, address=self.__address, uri=API_GET_TOKEN)
-            access_token, expire_in = _get_token(self.__buin, self.__app_id, token_url, self.__crypto)
-            self.__token_info = (access_token, expire_in, now)
+        self.__token_manager.cancel_refresh()
+        self.__session.close()
+
+    def __access_token(self):
+        """
+        获取accessToken，由同一应用共用的TokenManager负责刷新
+        """
+        return self.__token_manager.token(self.__fetch_token)
+
+    def __fetch_token(self):
+        """
+        请求新的accessToken
+        """
+        token_url = '{scheme}{address}{uri}'.format(
+            scheme=SCHEME, address=self.__address, uri=API_GET_TOKEN)
+        return _get_token(self.__session, self.__buin, self.__app_id, token_url, self.__crypto)
 
     def send_msg(self, msg):
         """
@@ -96,9 +126,8 @@ class AppClient(object):
         :type msg: Message
         """
         check_type(msg, Message)
-        self.__check_and_refresh_token()
-        url = _url_with_token(self.__address, API_SEND_MSG, self.__token_info[0])
-        _send_msg(self.__buin, self.__app_id, url, self.__crypto, msg)
+        url = _url_with_token(self.__address, API_SEND_MSG, self.__access_token())
+        _send_msg(self.__session, self.__buin, self.__app_id, url, self.__crypto, msg)
 
     def upload_file(self, file_type, file_name, file_path):
         """
@@ -120,9 +149,8 @@ class AppClient(object):
         check_type(file_type, str)
         check_types(file_name, unicode_str(), str)
         check_types(file_path, unicode_str(), str)
-        self.__check_and_refresh_token()
-        url = _url_with_token(self.__address, API_UPLOAD_FILE, self.__token_info[0])
-        return _upload_file(self.__buin, self.__app_id, url, self.__crypto, file_type, pystr(file_name), pystr(file_path))
+        url = _url_with_token(self.__address, API_UPLOAD_FILE, self.__access_token())
+        return _upload_file(self.__session, self.__buin, self.__app_id, url, self.__crypto, file_type, pystr(file_name), pystr(file_path))
 
     def download_file(self, media_id, out_dir):
         """
@@ -141,9 +169,29 @@ class AppClient(object):
         """
         check_types(media_id, unicode_str(), str)
         check_types(out_dir, unicode_str(), str)
-        self.__check_and_refresh_token()
-        url = _url_with_token(self.__address, API_DOWNLOAD_FILE, self.__token_info[0])
-        return _download_file(self.__buin, self.__app_id, url, self.__crypto, pystr(media_id), pystr(out_dir))
+        url = _url_with_token(self.__address, API_DOWNLOAD_FILE, self.__access_token())
+        return _download_file(self.__session, self.__buin, self.__app_id, url, self.__crypto, pystr(media_id), pystr(out_dir))
+
+    def download_file_stream(self, media_id, out_dir):
+        """
+        流式下载文件，分块解密写入临时文件后重命名，不在内存中保留文件内容
+        :param media_id: 资源Id
+        :param out_dir: 输出文件的目录
+        :return: (path: 文件路径, size: 文件大小，单位：字节)
+        :except AESCryptoError: 解密失败
+        :except ParamParserError: 参数解析错误
+        :except HttpRequestError: http请求错误
+        :except FileIOError: 写文件错误
+
+        :type media_id: unicode or str
+        :type out_dir: unicode or str
+        :rtype: (str, int)
+        """
+        check_types(media_id, unicode_str(), str)
+        check_types(out_dir, unicode_str(), str)
+        url = _url_with_token(self.__address, API_DOWNLOAD_FILE, self.__access_token())
+        return _download_file_stream(self.__session, self.__buin, self.__app_id, url, self.__crypto,
+                                     pystr(media_id), pystr(out_dir))
 
     def search_file(self, media_id):
         """
@@ -158,9 +206,104 @@ class AppClient(object):
         :rtype: (str, int)
         """
         check_types(media_id, unicode_str(), str)
-        self.__check_and_refresh_token()
-        url = _url_with_token(self.__address, API_SEARCHE_FILE, self.__token_info[0])
-        return _search_file(self.__buin, self.__app_id, url, self.__crypto, pystr(media_id))
+        url = _url_with_token(self.__address, API_SEARCHE_FILE, self.__access_token())
+        return _search_file(self.__session, self.__buin, self.__app_id, url, self.__crypto, pystr(media_id))
+
+
+class _Session(requests.Session):
+    """
+    带默认超时时间的requests会话
+    """
+
+    def __init__(self, timeout):
+        super(_Session, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(_Session, self).request(method, url, **kwargs)
+
+
+def _new_session(pool_size, max_retries, timeout):
+    """
+    创建带连接池的requests会话，只在建立连接失败时重试，避免重复发送消息
+    :param pool_size: 连接池大小
+    :param max_retries: 重试次数
+    :param timeout: 请求超时时间
+    :return: requests会话
+
+    :type pool_size: int
+    :type max_retries: int
+    :type timeout: int or float or tuple
+    :rtype: requests.Session
+    """
+    retry = Retry(total=max_retries, connect=max_retries, read=0, status=0, backoff_factor=0.1)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = _Session(timeout)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class _DecryptFileWriter(object):
+    """
+    边解密边写入临时文件，commit时校验并重命名到目标路径
+    """
+
+    def __init__(self, crypto_obj, out_dir, file_name):
+        """
+        构造函数
+        :param crypto_obj: 加密对象
+        :param out_dir: 输出文件的目录
+        :param file_name: 文件名称
+        :except FileIOError: 创建临时文件失败
+
+        :type crypto_obj: AESCrypto
+        :type out_dir: str
+        :type file_name: str
+        """
+        self.path = abspath(join(out_dir, file_name))
+        self.size = 0
+        self.__decryptor = crypto_obj.decryptor()
+        try:
+            fd, self.__tmp_path = tempfile.mkstemp(dir=out_dir, prefix='.download-')
+        except (IOError, OSError) as e:
+            raise FileIOError('failed to save file to {path}'.format(path=out_dir), e)
+        self.__file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        """
+        解密并写入一段base64编码的密文
+        :except AESCryptoError: 解密失败
+        :except FileIOError: 写文件错误
+        """
+        data = self.__decryptor.update(chunk)
+        try:
+            self.__file.write(data)
+        except (IOError, OSError) as e:
+            raise FileIOError('failed to save file to {path}'.format(path=self.path), e)
+        self.size += len(data)
+
+    def commit(self):
+        """
+        校验密文并把临时文件重命名到目标路径
+        :except AESCryptoError: 校验失败
+        :except FileIOError: 写文件错误
+        """
+        self.__decryptor.finalize()
+        try:
+            self.__file.close()
+            os.replace(self.__tmp_path, self.path)
+        except (IOError, OSError) as e:
+            raise FileIOError('failed to save file to {path}'.format(path=self.path), e)
+
+    def abort(self):
+        """
+        放弃写入，删除临时文件
+        """
+        self.__file.close()
+        if os.path.exists(self.__tmp_path):
+            os.remove(self.__tmp_path)
 
 
 def _url_with_token(address, uri, token):
@@ -214,9 +357,10 @@ def _parse_err(resp_json):
         raise HttpRequestError(err_code, pystr(err_msg))
 
 
-def _get_token(buin, app_id, url, crypto_obj):
+def _get_token(session, buin, app_id, url, crypto_obj):
     """
     获取accessToken
+    :param session: requests会话，也可以直接传入requests模块
     :param buin: 企业总机号
     :param app_id: AppId
     :param url: 请求url
@@ -226,6 +370,7 @@ def _get_token(buin, app_id, url, crypto_obj):
     :except ParamParserError: 参数解析错误
     :except HttpRequestError: http请求错误
 
+    :type session: requests.Session
     :type buin: int
     :type app_id: str
     :type url: str
@@ -236,7 +381,7 @@ def _get_token(buin, app_id, url, crypto_obj):
     param = {'buin': buin, 'appId': app_id, 'encrypt': cipher_text}
     json_result = dict()
     try:
-        rsp = requests.post(url, json=param)
+        rsp = session.post(url, json=param)
         _parse_status(rsp)
         json_result = rsp.json()
         _parse_err(json_result)
@@ -250,7 +395,7 @@ def _get_token(buin, app_id, url, crypto_obj):
         raise ParamParserError('encrypt content not exists')
 
     try:
-        token_info = json_loads_utf8(pystr(crypto_obj.decrypt(encrypt_string)))
+        token_info = json_loads_utf8(pystr(crypto_obj.decrypt_view(encrypt_string)))
         token = token_info.get('accessToken')
         expire_in = token_info.get('expireIn')
         if not is_instance(token, unicode_str(), str) and not isinstance(expire_in, int):
@@ -261,9 +406,10 @@ def _get_token(buin, app_id, url, crypto_obj):
         raise ParamParserError('parse json failed ', e)
 
 
-def _send_msg(buin, app_id, url, crypto_obj, msg):
+def _send_msg(session, buin, app_id, url, crypto_obj, msg):
     """
     发送消息
+    :param session: requests会话，也可以直接传入requests模块
     :param buin: 企业总机号
     :param app_id: AppId
     :param url: 带token的请求URL
@@ -273,6 +419,7 @@ def _send_msg(buin, app_id, url, crypto_obj, msg):
     :except ParamParserError: 参数解析错误
     :except HttpRequestError: http请求错误
 
+    :type session: requests.Session
     :type buin: int
     :type app_id: str
     :type url: str
@@ -282,7 +429,7 @@ def _send_msg(buin, app_id, url, crypto_obj, msg):
     cipher_text = crypto_obj.encrypt(bytestr(msg.to_json_string()))
     param = {'buin': buin, 'appId': app_id, 'encrypt': cipher_text}
     try:
-        rsp = requests.post(url, json=param)
+        rsp = session.post(url, json=param)
         _parse_status(rsp)
         _parse_err(rsp.json())
     except requests.RequestException as e:
@@ -291,9 +438,10 @@ def _send_msg(buin, app_id, url, crypto_obj, msg):
         raise ParamParserError('failed to decode json', e)
 
 
-def _upload_file(buin, app_id, url, crypto_obj, file_type, file_name, file_path):
+def _upload_file(session, buin, app_id, url, crypto_obj, file_type, file_name, file_path):
     """
     上传文件
+    :param session: requests会话，也可以直接传入requests模块
     :param buin: 企业总机号
     :param app_id: AppId
     :param url: 带token的请求URL
@@ -307,6 +455,7 @@ def _upload_file(buin, app_id, url, crypto_obj, file_type, file_name, file_path)
     :except HttpRequestError: http请求错误
     :except FileIOError: 读文件错误
 
+    :type session: requests.Session
     :type buin: int
     :type app_id: str
     :type url: str
@@ -317,43 +466,45 @@ def _upload_file(buin, app_id, url, crypto_obj, file_type, file_name, file_path)
     :rtype: str
     """
     cipher_request = crypto_obj.encrypt(bytestr(json.dumps({'type': file_type, 'name': file_name})))
-    encrypt_file = ''
     try:
-        with open(file_path, 'rb') as f:
-            encrypt_file = crypto_obj.encrypt(f.read())
-    except IOError as e:
+        f = open(file_path, 'rb')
+        file_size = os.fstat(f.fileno()).st_size
+    except (IOError, OSError) as e:
         raise FileIOError('failed to read from file {path}'.format(path=file_path), e)
 
-    encoder = MultipartEncoder(
-        fields={'buin': str(buin),
-                'appId': app_id,
-                'encrypt': cipher_request,
-                'file': ('file', encrypt_file, 'text/plain')}
-    )
+    with f:
+        # 边读边加密，内存占用与文件大小无关
+        encoder = MultipartEncoder(
+            fields={'buin': str(buin),
+                    'appId': app_id,
+                    'encrypt': cipher_request,
+                    'file': ('file', crypto_obj.encrypt_reader(f, file_size), 'text/plain')}
+        )
 
-    try:
-        rsp = requests.post(url, data=encoder, headers={'Content-Type': encoder.content_type})
-        _parse_status(rsp)
-        json_result = rsp.json()
-        _parse_err(json_result)
-        cipher_id = json_result.get('encrypt')
-        if not is_instance(cipher_id, unicode_str(), str):
-            raise ParamParserError('encrypt content not exists')
+        try:
+            rsp = session.post(url, data=encoder, headers={'Content-Type': encoder.content_type})
+            _parse_status(rsp)
+            json_result = rsp.json()
+            _parse_err(json_result)
+            cipher_id = json_result.get('encrypt')
+            if not is_instance(cipher_id, unicode_str(), str):
+                raise ParamParserError('encrypt content not exists')
 
-        media_id = json_loads_utf8(pystr(crypto_obj.decrypt(cipher_id))).get('mediaId', '')
-        if not is_instance(media_id, unicode_str(), str):
-            raise ParamParserError('result invalid')
+            media_id = json_loads_utf8(pystr(crypto_obj.decrypt_view(cipher_id))).get('mediaId', '')
+            if not is_instance(media_id, unicode_str(), str):
+                raise ParamParserError('result invalid')
 
-        return pystr(media_id)
-    except requests.RequestException as e:
-        raise HttpRequestError(0, 'connect failed', e)
-    except ValueError as e:
-        raise ParamParserError('failed to decode json', e)
+            return pystr(media_id)
+        except requests.RequestException as e:
+            raise HttpRequestError(0, 'connect failed', e)
+        except ValueError as e:
+            raise ParamParserError('failed to decode json', e)
 
 
-def _download_file(buin, app_id, url, crypto_obj, media_id, out_dir):
+def _download_file(session, buin, app_id, url, crypto_obj, media_id, out_dir):
     """
     下载文件
+    :param session: requests会话，也可以直接传入requests模块
     :param buin: 企业总机号
     :param app_id: AppId
     :param url: 带token的请求URL
@@ -366,6 +517,7 @@ def _download_file(buin, app_id, url, crypto_obj, media_id, out_dir):
     :except HttpRequestError: http请求错误
     :except FileIOError: 写文件错误
 
+    :type session: requests.Session
     :type buin: int
     :type app_id: str
     :type url: str
@@ -377,7 +529,7 @@ def _download_file(buin, app_id, url, crypto_obj, media_id, out_dir):
     cipher_id = crypto_obj.encrypt(bytestr(json.dumps({'mediaId': media_id})))
     param = {'buin': buin, 'appId': app_id, 'encrypt': cipher_id}
     try:
-        rsp = requests.post(url, json=param)
+        rsp = session.post(url, json=param)
         _parse_status(rsp)
         json_result = None
         try:
@@ -391,18 +543,17 @@ def _download_file(buin, app_id, url, crypto_obj, media_id, out_dir):
         if not is_instance(cipher_info, unicode_str(), str):
             raise ParamParserError('encrypt content not exists')
 
-        file_info = json_loads_utf8(pystr(crypto_obj.decrypt(cipher_info)))
+        file_info = json_loads_utf8(pystr(crypto_obj.decrypt_view(cipher_info)))
         file_name = file_info.get('name')
         file_size = file_info.get('size')
         if not is_instance(file_name, unicode_str(), str) and isinstance(file_size, int):
             raise ParamParserError('name or size not exists')
 
-        file_content = bytestr('')
+        file_content = crypto_obj.decrypt_view(rsp.content)
         with open(abspath(join(out_dir, pystr(file_name))), 'wb') as f:
-            file_content = crypto_obj.decrypt(pystr(rsp.content))
             f.write(file_content)
 
-        return pystr(file_name), file_size, file_content
+        return pystr(file_name), file_size, file_content.tobytes()
 
     except requests.RequestException as e:
         raise HttpRequestError(0, 'connect failed', e)
@@ -412,9 +563,82 @@ def _download_file(buin, app_id, url, crypto_obj, media_id, out_dir):
         raise FileIOError('failed to save file to {path}'.format(path=out_dir), e)
 
 
-def _search_file(buin, app_id, url, crypto_obj, media_id):
+def _download_file_stream(session, buin, app_id, url, crypto_obj, media_id, out_dir):
+    """
+    流式下载文件
+    :param session: requests会话，也可以直接传入requests模块
+    :param buin: 企业总机号
+    :param app_id: AppId
+    :param url: 带token的请求URL
+    :param crypto_obj: 加密对象
+    :param media_id: 资源Id
+    :param out_dir: 输出文件的目录
+    :return: (path: 文件路径, size: 文件大小，单位：字节)
+    :except AESCryptoError: 解密失败
+    :except ParamParserError: 参数解析错误
+    :except HttpRequestError: http请求错误
+    :except FileIOError: 写文件错误
+
+    :type session: requests.Session
+    :type buin: int
+    :type app_id: str
+    :type url: str
+    :type crypto_obj: AESCrypto
+    :type media_id: str
+    :type out_dir: str
+    :rtype: (str, int)
+    """
+    cipher_id = crypto_obj.encrypt(bytestr(json.dumps({'mediaId': media_id})))
+    param = {'buin': buin, 'appId': app_id, 'encrypt': cipher_id}
+    try:
+        with session.post(url, json=param, stream=True) as rsp:
+            _parse_status(rsp)
+            file_name = _parse_file_header(rsp.headers, crypto_obj, rsp.json)
+
+            writer = _DecryptFileWriter(crypto_obj, out_dir, file_name)
+            try:
+                for chunk in rsp.iter_content(DEFAULT_CHUNK_SIZE):
+                    writer.write(chunk)
+                writer.commit()
+            except BaseException:
+                writer.abort()
+                raise
+
+            return writer.path, writer.size
+    except requests.RequestException as e:
+        raise HttpRequestError(0, 'connect failed', e)
+    except ValueError as e:
+        raise ParamParserError('failed to decode json', e)
+
+
+def _parse_file_header(headers, crypto_obj, read_json):
+    """
+    从下载响应的encrypt头解析文件名，不存在时按错误JSON处理
+    :param headers: 响应头
+    :param crypto_obj: 加密对象
+    :param read_json: 读取响应JSON的函数，只在encrypt头不存在时调用
+    :return: 文件名称
+    :except ParamParserError: 参数解析错误
+    :except HttpRequestError: 接口返回错误码
+
+    :rtype: str
+    """
+    cipher_info = headers.get('encrypt')
+    if not is_instance(cipher_info, unicode_str(), str):
+        _parse_err(read_json())  # 失败的时候返回错误JSON
+        raise ParamParserError('encrypt content not exists')
+
+    file_info = json_loads_utf8(pystr(crypto_obj.decrypt_view(cipher_info)))
+    file_name = file_info.get('name')
+    if not is_instance(file_name, unicode_str(), str):
+        raise ParamParserError('name not exists')
+    return pystr(file_name)
+
+
+def _search_file(session, buin, app_id, url, crypto_obj, media_id):
     """
     搜索文件信息
+    :param session: requests会话，也可以直接传入requests模块
     :param buin: 企业总机号
     :param app_id: AppId
     :param url: 带token的请求URL
@@ -425,6 +649,7 @@ def _search_file(buin, app_id, url, crypto_obj, media_id):
     :except ParamParserError: 参数解析错误
     :except HttpRequestError: http请求错误
 
+    :type session: requests.Session
     :type buin: int
     :type app_id: str
     :type url: str
@@ -435,7 +660,7 @@ def _search_file(buin, app_id, url, crypto_obj, media_id):
     cipher_id = crypto_obj.encrypt(bytestr(json.dumps({'mediaId': media_id})))
     param = {'buin': buin, 'appId': app_id, 'encrypt': cipher_id}
     try:
-        rsp = requests.post(url, json=param)
+        rsp = session.post(url, json=param)
         _parse_status(rsp)
         json_result = rsp.json()
         _parse_err(json_result)
@@ -443,7 +668,7 @@ def _search_file(buin, app_id, url, crypto_obj, media_id):
         if not is_instance(encrypt_result, unicode_str(), str):
             raise ParamParserError('encrypt content not exists')
 
-        file_info = json_loads_utf8(pystr(crypto_obj.decrypt(encrypt_result)))
+        file_info = json_loads_utf8(pystr(crypto_obj.decrypt_view(encrypt_result)))
         name = file_info.get('name', '')
         size = file_info.get('size', 0)
         if name == '' or size <= 0:
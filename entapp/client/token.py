@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+"""
+accessToken管理
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from entapp.utils import *
+
+
+DEFAULT_REFRESH_RATIO = 0.8
+# 后台刷新失败后第一次重试的间隔，单位：秒
+RETRY_DELAY = 5
+
+
+class TokenManager(object):
+    """
+    accessToken管理器
+    同一个(buin, appId, address)的所有客户端共用一个实例，token过期前按比例提前在后台刷新，
+    同一时间只有一个刷新请求，其他调用方等待该请求的结果
+    """
+
+    __instances = {}
+    __instances_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls, buin, app_id, address, refresh_ratio=DEFAULT_REFRESH_RATIO, cache=None):
+        """
+        获取共用的管理器，refresh_ratio只在第一次创建时生效
+        :param buin: 企业总机号
+        :param app_id: AppId
+        :param address: 有度服务器地址（IP:PORT）
+        :param refresh_ratio: 在expireIn的多少比例时提前刷新
+        :param cache: token磁盘缓存，已有管理器未设置缓存时补充设置
+
+        :type buin: int
+        :type app_id: str
+        :type address: str
+        :type refresh_ratio: float
+        :type cache: TokenCache
+        :rtype: TokenManager
+        """
+        key = (buin, app_id, address)
+        with cls.__instances_lock:
+            manager = cls.__instances.get(key)
+            if manager is None:
+                manager = cls(refresh_ratio, cache, key)
+                cls.__instances[key] = manager
+            elif cache is not None and manager.cache is None:
+                manager.cache = cache
+            return manager
+
+    def __init__(self, refresh_ratio=DEFAULT_REFRESH_RATIO, cache=None, key=None):
+        """
+        构造函数
+        :param refresh_ratio: 在expireIn的多少比例时提前刷新
+        :param cache: token磁盘缓存
+        :param key: 缓存的key，(buin, appId, address)
+
+        :type refresh_ratio: float
+        :type cache: TokenCache
+        :type key: tuple
+        """
+        if not 0 < refresh_ratio <= 1:
+            raise ValueError('refresh_ratio must be in (0, 1]')
+        if cache is not None and key is None:
+            raise ValueError('key is required when cache is set')
+        self.__refresh_ratio = refresh_ratio
+        self.cache = cache
+        self.__key = key
+        self.__cache_loaded = False
+        self.__token_info = None
+        self.__lock = threading.Lock()
+        self.__async_lock = None
+        self.__timer = None
+        self.__task = None
+
+    @property
+    def refresh_ratio(self):
+        """
+        在expireIn的多少比例时提前刷新
+        :rtype: float
+        """
+        return self.__refresh_ratio
+
+    def __valid_token(self):
+        """
+        未过期的token，不存在或者已过期返回None
+        """
+        info = self.__token_info
+        if info is None or info[1] + info[2] < time.time():
+            return None
+        return info[0]
+
+    def __update(self, access_token, expire_in, fetch_time):
+        self.__token_info = (access_token, expire_in, fetch_time)
+        if self.cache is not None:
+            try:
+                self.cache.save(self.__key, self.__token_info)
+            except Exception as e:
+                print('写入token缓存失败:', e)
+        return access_token
+
+    def __load_cache(self):
+        """
+        第一次需要token时尝试读取磁盘缓存
+        :return: 缓存中未过期的token，没有则返回None
+        """
+        if self.cache is None or self.__cache_loaded:
+            return None
+        self.__cache_loaded = True
+        try:
+            self.__token_info = self.cache.load(self.__key)
+        except Exception as e:
+            print('读取token缓存失败:', e)
+        return self.__valid_token()
+
+    def __refresh_delay(self):
+        info = self.__token_info
+        return max(info[1] * self.__refresh_ratio - (time.time() - info[2]), 0)
+
+    def __retry_delay(self, attempt):
+        """
+        后台刷新失败后的重试间隔，按失败次数指数退避，不超过token剩余有效期
+        :return: 重试间隔，token已过期时返回None，不再重试
+        """
+        info = self.__token_info
+        remaining = info[1] + info[2] - time.time() if info is not None else 0
+        if remaining <= 0:
+            return None
+        return min(RETRY_DELAY * 2 ** attempt, remaining)
+
+    def token(self, fetch):
+        """
+        获取token，需要刷新时阻塞等待
+        :param fetch: 请求新token的函数，返回(token, expire_in)
+        :return: accessToken
+
+        :type fetch: callable
+        :rtype: str
+        """
+        access_token = self.__valid_token()
+        if access_token is not None:
+            return access_token
+
+        with self.__lock:
+            access_token = self.__valid_token()
+            if access_token is not None:
+                return access_token
+            access_token = self.__load_cache()
+            if access_token is not None:
+                self.__schedule(fetch)
+                return access_token
+            return self.__refresh(fetch)
+
+    def __refresh(self, fetch):
+        now = time.time()
+        access_token, expire_in = fetch()
+        self.__update(access_token, expire_in, now)
+        self.__schedule(fetch)
+        return access_token
+
+    def __schedule(self, fetch, delay=None, attempt=0):
+        self.cancel_refresh()
+        delay = self.__refresh_delay() if delay is None else delay
+        timer = threading.Timer(delay, self.__background_refresh, (fetch, attempt))
+        timer.daemon = True
+        timer.start()
+        self.__timer = timer
+
+    def __background_refresh(self, fetch, attempt=0):
+        with self.__lock:
+            try:
+                self.__refresh(fetch)
+            except Exception as e:
+                delay = self.__retry_delay(attempt)
+                print('后台刷新token失败:', e, '重试间隔:', delay)
+                if delay is not None:
+                    self.__schedule(fetch, delay, attempt + 1)
+
+    async def async_token(self, fetch):
+        """
+        获取token，需要刷新时等待
+        :param fetch: 请求新token的协程函数，返回(token, expire_in)
+        :return: accessToken
+
+        :type fetch: callable
+        :rtype: str
+        """
+        access_token = self.__valid_token()
+        if access_token is not None:
+            return access_token
+
+        if self.__async_lock is None:
+            self.__async_lock = asyncio.Lock()
+        async with self.__async_lock:
+            access_token = self.__valid_token()
+            if access_token is not None:
+                return access_token
+            access_token = self.__load_cache()
+            if access_token is not None:
+                self.__async_schedule(fetch)
+                return access_token
+            return await self.__async_refresh(fetch)
+
+    async def __async_refresh(self, fetch):
+        now = time.time()
+        access_token, expire_in = await fetch()
+        self.__update(access_token, expire_in, now)
+        self.__async_schedule(fetch)
+        return access_token
+
+    def __async_schedule(self, fetch, delay=None, attempt=0):
+        self.cancel_refresh()
+        loop = asyncio.get_running_loop()
+        delay = self.__refresh_delay() if delay is None else delay
+        self.__timer = loop.call_later(delay, self.__start_background_task, fetch, attempt)
+
+    def __start_background_task(self, fetch, attempt=0):
+        self.__task = asyncio.ensure_future(self.__async_background_refresh(fetch, attempt))
+
+    async def __async_background_refresh(self, fetch, attempt=0):
+        if self.__async_lock is None:
+            self.__async_lock = asyncio.Lock()
+        async with self.__async_lock:
+            try:
+                await self.__async_refresh(fetch)
+            except Exception as e:
+                delay = self.__retry_delay(attempt)
+                print('后台刷新token失败:', e, '重试间隔:', delay)
+                if delay is not None:
+                    self.__async_schedule(fetch, delay, attempt + 1)
+
+    def cancel_refresh(self):
+        """
+        取消已计划的后台刷新，token仍然有效，过期后在下一次调用时刷新
+        """
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+
+class TokenCache(object):
+    """
+    accessToken磁盘缓存，按(buin, appId, address)分文件保存，内容用AESCrypto加密，写入时先写临时文件再重命名
+    """
+
+    def __init__(self, cache_dir, crypto_obj):
+        """
+        构造函数
+        :param cache_dir: 缓存目录
+        :param crypto_obj: 加密对象
+
+        :type cache_dir: str
+        :type crypto_obj: AESCrypto
+        """
+        self.__cache_dir = cache_dir
+        self.__crypto = crypto_obj
+
+    @property
+    def cache_dir(self):
+        """
+        缓存目录
+        :rtype: str
+        """
+        return self.__cache_dir
+
+    def path(self, key):
+        """
+        缓存文件路径
+        :param key: (buin, appId, address)
+        :rtype: str
+        """
+        digest = hashlib.sha1(bytestr('{0}:{1}:{2}'.format(*key))).hexdigest()
+        return os.path.join(self.__cache_dir, 'youdu-token-{digest}.cache'.format(digest=digest))
+
+    def load(self, key):
+        """
+        读取缓存
+        :param key: (buin, appId, address)
+        :return: (token, expire_in, fetch_time)，不存在或者不匹配返回None
+        :except AESCryptoError: 解密失败
+
+        :type key: tuple
+        :rtype: (str, int, float)
+        """
+        try:
+            with open(self.path(key), 'r') as f:
+                cipher_text = f.read()
+        except IOError:
+            return None
+
+        info = json_loads_utf8(pystr(self.__crypto.decrypt(cipher_text)))
+        if [info.get('buin'), info.get('appId'), info.get('address')] != list(key):
+            return None
+        return info['accessToken'], info['expireIn'], info['fetchTime']
+
+    def save(self, key, token_info):
+        """
+        写入缓存
+        :param key: (buin, appId, address)
+        :param token_info: (token, expire_in, fetch_time)
+
+        :type key: tuple
+        :type token_info: tuple
+        """
+        plain_text = json.dumps({
+            'buin': key[0], 'appId': key[1], 'address': key[2],
+            'accessToken': token_info[0], 'expireIn': token_info[1], 'fetchTime': token_info[2]})
+        cipher_text = self.__crypto.encrypt(bytestr(plain_text))
+
+        if not os.path.isdir(self.__cache_dir):
+            os.makedirs(self.__cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=self.__cache_dir, prefix='.youdu-token-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(cipher_text)
+            os.replace(tmp_path, self.path(key))
+        except Exception:
+            os.remove(tmp_path)
+            raise
@@ -67,7 +67,7 @@ def pystr(text):
     :param text: 字符串或字节数组
     :return: str对象
 
-    :type text: bytes or unicode or str
+    :type text: bytes or unicode or str or bytearray or memoryview
     :rtype: str
     """
     if PYTHON_VERSION < 3:
@@ -82,6 +82,9 @@ def pystr(text):
             return text.decode(encoding='utf_8', errors='strict')
         elif isinstance(text, str):
             return text
+        elif isinstance(text, (bytearray, memoryview)):
+            # 直接从缓冲区解码，不先拷贝成bytes
+            return str(text, encoding='utf_8', errors='strict')
         else:
             raise TypeError('the value does not match type: str or bytes')
 
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+"""
+多进程启动器：启动 WORKERS 个 app.py 进程，前端分发器按 fromUser 的哈希把回调固定转发到同一个进程，
+用户会话始终留在该进程内
+
+    python launcher.py
+
+kill -HUP <pid> 逐个平滑重启 worker，worker 异常退出后自动重启
+"""
+
+import asyncio
+import os
+import signal
+import sys
+import time
+import zlib
+
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+
+from entapp.aes import AESCrypto
+from entapp.utils import *
+
+from environs import Env
+env = Env()
+env.read_env()
+
+HOST = env.str('HOST', None)
+PORT = env.int('PORT', 8080)
+RECEIVE_MSG_API = env.str('RECEIVE_MSG_API', '/receive_msg')
+STATS_API = env.str('STATS_API', '/stats')
+YOUDU_APP_ID = env.str('YOUDU_APP_ID')
+YOUDU_AES_KEY = env.str('YOUDU_AES_KEY')
+
+WORKERS = env.int('WORKERS', os.cpu_count() or 1)
+# worker 监听 127.0.0.1 上 WORKER_BASE_PORT 开始的端口，每个 worker 占两个端口，平滑重启时交替使用
+WORKER_BASE_PORT = env.int('WORKER_BASE_PORT', PORT + 1)
+WORKER_START_TIMEOUT = env.int('WORKER_START_TIMEOUT', 60)
+WORKER_STOP_TIMEOUT = env.int('WORKER_STOP_TIMEOUT', 30)
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+
+class Worker(object):
+    """
+    一个 app.py 子进程
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.port = None
+        self.proc = None
+        self.restarts = 0
+        self.lock = asyncio.Lock()
+        # 重启期间暂停转发，旧进程退出后再把消息转发给新进程
+        self.ready = asyncio.Event()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def next_port(self):
+        base = WORKER_BASE_PORT + self.index * 2
+        return base + 1 if self.port == base else base
+
+    async def spawn(self, port):
+        environ = dict(os.environ, HOST='127.0.0.1', PORT=str(port), WORKER_ID=str(self.index))
+        proc = await asyncio.create_subprocess_exec(sys.executable, APP_PATH, env=environ)
+        deadline = time.time() + WORKER_START_TIMEOUT
+        while time.time() < deadline:
+            if proc.returncode is not None:
+                raise RuntimeError(f'worker {self.index} 启动失败，退出码: {proc.returncode}')
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.close()
+                return proc
+            except OSError:
+                await asyncio.sleep(0.2)
+        await stop_process(proc)
+        raise RuntimeError(f'worker {self.index} 启动超时')
+
+    async def start(self):
+        async with self.lock:
+            port = self.next_port()
+            self.proc = await self.spawn(port)
+            self.port = port
+            self.ready.set()
+            print(f'worker {self.index} 已启动, pid: {self.proc.pid}, port: {port}')
+
+    async def restart(self):
+        """
+        先在另一个端口启动新进程，就绪后暂停转发，等旧进程处理完已接收的消息、写回会话退出后，再切换到新进程
+        避免旧进程退出时写回的会话覆盖新进程中更新的会话
+        """
+        async with self.lock:
+            old = self.proc
+            port = self.next_port()
+            proc = await self.spawn(port)
+            self.ready.clear()
+            self.proc = proc
+            self.port = port
+            self.restarts += 1
+            try:
+                if old is not None:
+                    await stop_process(old)
+            finally:
+                self.ready.set()
+            print(f'worker {self.index} 已重启, pid: {self.proc.pid}, port: {port}')
+
+    async def stop(self):
+        async with self.lock:
+            if self.proc is not None:
+                proc, self.proc = self.proc, None
+                await stop_process(proc)
+
+
+async def stop_process(proc):
+    if proc.returncode is not None:
+        return
+    proc.terminate()
+    try:
+        await asyncio.wait_for(proc.wait(), WORKER_STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+
+
+"""
+转发
+"""
+crypto = AESCrypto(YOUDU_APP_ID, YOUDU_AES_KEY)
+workers = [Worker(i) for i in range(WORKERS)]
+
+
+def route(body):
+    """
+    按 fromUser 选择 worker，解析失败的请求交给第一个 worker 校验并拒绝
+    """
+    try:
+        encrypt = json_loads_utf8(pystr(body)).get('encrypt')
+        msg = json_loads_utf8(pystr(crypto.decrypt_view(encrypt)))
+        from_user = bytestr(str(msg.get('fromUser') or ''))
+    except Exception:
+        return workers[0]
+    return workers[zlib.crc32(from_user) % len(workers)]
+
+
+async def forward(req, worker, body):
+    # worker 按这里接收回调的时间判断消息是否过期，重启期间暂停转发的等待时间不计入
+    headers = {'Content-Type': req.headers.get('Content-Type', 'application/json'), 'X-Received-At': str(time.time())}
+    await worker.ready.wait()
+    async with req.app['client'].request(req.method, worker.url + req.path_qs, data=body, headers=headers) as resp:
+        return web.Response(body=await resp.read(), status=resp.status, content_type=resp.content_type)
+
+
+async def receive_msg(req):
+    body = await req.read()
+    worker = route(body) if req.method == 'POST' else workers[0]
+    return await forward(req, worker, body)
+
+
+async def stats(req):
+    async def fetch(worker):
+        try:
+            async with req.app['client'].get(worker.url + STATS_API) as resp:
+                return await resp.json()
+        except Exception as e:
+            return {'error': str(e)}
+
+    results = await asyncio.gather(*[fetch(worker) for worker in workers])
+    return web.json_response({'workers': [
+        dict(result, index=worker.index, pid=worker.proc and worker.proc.pid, restarts=worker.restarts)
+        for worker, result in zip(workers, results)]})
+
+
+"""
+进程管理
+"""
+async def restart_all():
+    for worker in workers:
+        try:
+            await worker.restart()
+        except Exception as e:
+            print(e)
+
+
+async def watch(worker):
+    """
+    worker 异常退出后重启，连续失败时逐步延长等待时间
+    """
+    delay = 1
+    while True:
+        proc = worker.proc
+        if proc is None:
+            await asyncio.sleep(1)
+            continue
+        await proc.wait()
+        if worker.proc is not proc:
+            continue
+        print(f'worker {worker.index} 已退出, 退出码: {proc.returncode}, {delay} 秒后重启')
+        await asyncio.sleep(delay)
+        try:
+            if worker.proc is proc:
+                await worker.restart()
+            delay = 1
+        except Exception as e:
+            print(e)
+            delay = min(delay * 2, 60)
+
+
+async def start_workers(app):
+    app['client'] = ClientSession(connector=TCPConnector(limit=0), timeout=ClientTimeout(total=None))
+    results = await asyncio.gather(*[worker.start() for worker in workers], return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        await asyncio.gather(*[worker.stop() for worker in workers])
+        await app['client'].close()
+        raise errors[0]
+    app['watchers'] = [asyncio.create_task(watch(worker)) for worker in workers]
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGHUP, lambda: asyncio.ensure_future(restart_all()))
+
+
+async def stop_workers(app):
+    for task in app['watchers']:
+        task.cancel()
+    await asyncio.gather(*app['watchers'], return_exceptions=True)
+    await asyncio.gather(*[worker.stop() for worker in workers])
+    await app['client'].close()
+
+
+def init_server():
+    app = web.Application()
+    app.router.add_post(RECEIVE_MSG_API, receive_msg)
+    app.router.add_get(RECEIVE_MSG_API, receive_msg)
+    app.router.add_get(STATS_API, stats)
+    app.on_startup.append(start_workers)
+    app.on_cleanup.append(stop_workers)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(init_server(), host=HOST, port=PORT)
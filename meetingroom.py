@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""
+会议室目录和占用表
+"""
+
+import json
+import re
+from bisect import bisect_left
+from collections import namedtuple
+from types import MappingProxyType
+
+SLOT_MINUTES = 30
+# 从会议室名称中提取简称，兼容只说房间号、“贵宾”、“休闲”的提问
+SHORT_NAME = re.compile(r'.*(\d{4}|贵宾|休闲).*')
+
+
+def time_to_minutes(time_str):
+    hour, minute = time_str.split(':')
+    return int(hour) * 60 + int(minute)
+
+
+def minutes_to_time(minutes):
+    return f"{str(minutes // 60).zfill(2)}:{str(minutes % 60).zfill(2)}"
+
+
+def slot_mask(start, end):
+    """
+    时段 [start, end) 对应的位掩码
+    """
+    return (1 << end) - (1 << start)
+
+
+def normalize_name(name):
+    return re.sub(r'\s+', '', name).lower()
+
+
+def short_name(name):
+    match = SHORT_NAME.match(name)
+    return match.group(1) if match is not None else None
+
+
+class Room(namedtuple('Room', ['area', 'name', 'capacity', 'aliases'])):
+    """
+    会议室，area 为 OA 中的会议室 id
+    """
+
+    def to_dict(self):
+        return {'room_name': self.name, 'room_limit': self.capacity}
+
+
+class RoomCatalog(object):
+    """
+    会议室目录：会议室按 id、名称（含别名、简称）、容纳人数建索引，以及时段的开始、结束时间到下标的索引
+    创建后不再修改，可以在所有请求间共用
+    """
+
+    def __init__(self, rooms, time_slots):
+        """
+        构造函数
+        :param rooms: Room 列表
+        :param time_slots: 时段列表 [(start, end)]，时间格式为 HH:mm，按时间顺序
+        """
+        self.rooms = tuple(rooms)
+        self.time_slots = tuple(tuple(slot) for slot in time_slots)
+        self.by_area = MappingProxyType({room.area: room for room in self.rooms})
+
+        names = {}
+        for room in self.rooms:
+            names.setdefault(normalize_name(room.name), room)
+            for alias in room.aliases:
+                names.setdefault(normalize_name(alias), room)
+        # 简称可能重复（如两个休闲区），只在全名、别名都不匹配时使用，取第一个
+        short_names = {}
+        for room in self.rooms:
+            key = short_name(room.name)
+            if key is not None:
+                short_names.setdefault(key, room)
+        self.by_name = MappingProxyType(names)
+        self.by_short_name = MappingProxyType(short_names)
+
+        self.by_capacity = tuple(sorted(self.rooms, key=lambda room: room.capacity))
+        self._capacities = [room.capacity for room in self.by_capacity]
+
+        self.slot_by_start = MappingProxyType({start: i for i, (start, end) in enumerate(self.time_slots)})
+        self.slot_by_end = MappingProxyType({end: i + 1 for i, (start, end) in enumerate(self.time_slots)})
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        从配置创建
+        :param config: {"time_slots": {"start", "end", "minutes"} 或 [{"start", "end"}],
+                        "rooms": [{"area", "name", "capacity", "aliases"}]}
+        """
+        time_slots = config['time_slots']
+        if isinstance(time_slots, dict):
+            step = time_slots.get('minutes', SLOT_MINUTES)
+            start, end = time_to_minutes(time_slots['start']), time_to_minutes(time_slots['end'])
+            time_slots = [(minutes_to_time(minute), minutes_to_time(minute + step))
+                          for minute in range(start, end, step)]
+        else:
+            time_slots = [(slot['start'], slot['end']) for slot in time_slots]
+        rooms = [Room(str(room['area']), room['name'], int(room['capacity']), tuple(room.get('aliases', ())))
+                 for room in config['rooms']]
+        return cls(rooms, time_slots)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_config(json.load(f))
+
+    def find(self, name):
+        """
+        按名称、别名或简称查找会议室，找不到返回 None
+        """
+        room = self.by_name.get(normalize_name(name))
+        if room is None:
+            key = short_name(name)
+            room = self.by_short_name.get(key) if key is not None else None
+        return room
+
+    def with_capacity(self, capacity):
+        """
+        容纳人数不少于 capacity 的会议室，按容纳人数从小到大
+        """
+        return self.by_capacity[bisect_left(self._capacities, capacity):]
+
+    def room_name(self, area):
+        room = self.by_area.get(str(area))
+        return room.name if room is not None else str(area)
+
+
+class Schedule(object):
+    """
+    某一天所有会议室的占用表，每个会议室一个整数，第 i 位为 1 表示第 i 个半小时时段已被预订
+    由 OA 返回的预订数据构建一次，之后的查询都是位运算
+    """
+
+    def __init__(self, bookings, catalog):
+        """
+        构造函数
+        :param bookings: OA 返回的预订列表，area 为会议室 id，start、end 为开始、结束时段下标（包含结束时段）
+        :param catalog: RoomCatalog
+        """
+        self.bookings = bookings
+        self.catalog = catalog
+        self.occupied = dict.fromkeys(catalog.by_area, 0)
+        for booking in bookings:
+            area = str(booking['area'])
+            self.occupied[area] = self.occupied.get(area, 0) | slot_mask(int(booking['start']), int(booking['end']) + 1)
+
+    @property
+    def slot_count(self):
+        return len(self.catalog.time_slots)
+
+    def slot_range(self, start_time, end_time):
+        """
+        时间段对应的时段下标 [start, end)，不在可预订时段内返回 None
+        """
+        start = self.catalog.slot_by_start.get(start_time)
+        end = self.catalog.slot_by_end.get(end_time)
+        if start is None or end is None or start >= end:
+            return None
+        return start, end
+
+    def is_free(self, area, start, end):
+        """
+        会议室在时段 [start, end) 是否空闲
+        """
+        return not self.occupied.get(str(area), 0) & slot_mask(start, end)
+
+    def free_windows(self, area, min_slots=1):
+        """
+        会议室所有连续的空闲时段
+        :return: [(start, end)]，时段下标，不包含 end
+        """
+        free = ~self.occupied.get(str(area), 0) & slot_mask(0, self.slot_count)
+        windows = []
+        while free:
+            start = (free & -free).bit_length() - 1
+            # 从 start 开始的连续 1 的长度
+            length = (~(free >> start) & (free >> start) + 1).bit_length() - 1
+            if length >= min_slots:
+                windows.append((start, start + length))
+            free &= ~slot_mask(start, start + length)
+        return windows
+
+    def free_rooms(self, start, end, capacity=0):
+        """
+        时段 [start, end) 空闲、容纳人数不少于 capacity 的会议室，按容纳人数从小到大
+        :rtype: list[Room]
+        """
+        mask = slot_mask(start, end)
+        return [room for room in self.catalog.with_capacity(capacity) if not self.occupied.get(room.area, 0) & mask]
+
+    def window_text(self, start, end):
+        return f"{self.catalog.time_slots[start][0]}-{self.catalog.time_slots[end - 1][1]}"
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+
+"""
+OA 系统访问
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+from html.parser import HTMLParser
+
+import aiohttp
+
+OA_URL = 'https://oa.addcn.com'
+
+
+class BrowserLogin(object):
+    """
+    用 Playwright 浏览器登录 OA，取得登录 cookie 后关闭浏览器
+    只在没有可用 cookie 时使用，由 OAClient 保证同一时间只有一个登录
+    """
+
+    def __init__(self, work_id, password, headless=True, locale='zh-TW'):
+        """
+        构造函数
+        :param work_id: OA 账号
+        :param password: OA 密码
+        :param headless: 是否使用无头模式
+        """
+        self.work_id = work_id
+        self.password = password
+        self.headless = headless
+        self.locale = locale
+        self.logins = 0
+
+    async def login(self):
+        """
+        打开 OA 首页，跳转到登录页时填写账号密码登录
+        :return: 浏览器中的全部 cookie，[{name, value, expires, ...}]
+        """
+        from playwright.async_api import async_playwright
+        async with async_playwright() as playwright:
+            browser = await playwright.chromium.launch(headless=self.headless)
+            try:
+                context = await browser.new_context(locale=self.locale)
+                page = await context.new_page()
+                await page.goto(OA_URL + '/')
+                if await is_login_page(page):
+                    await page.locator('#work_id').fill(self.work_id)
+                    await page.locator('#pwd').fill(self.password)
+                    await page.locator('#rmbUser').click()
+                    await page.get_by_text('登 入').click()
+                    await page.wait_for_load_state('networkidle')
+                    if await is_login_page(page):
+                        raise RuntimeError('OA 登录失败，请检查 WORK_ID、WORK_PASSWORD')
+                self.logins += 1
+                return await context.cookies()
+            finally:
+                await browser.close()
+
+
+async def is_login_page(page):
+    return await page.locator('#work_id').count() > 0
+
+
+class OAClient(object):
+    """
+    OA 接口客户端：只在没有可用 cookie 时用浏览器登录，cookie 连同过期时间缓存到磁盘，
+    之后的页面和接口请求都通过共用的 aiohttp 连接池发送
+    """
+
+    def __init__(self, browser, cookie_file=None, cookie_ttl=12 * 60 * 60, pool_size=10, timeout=30):
+        """
+        构造函数
+        :param browser: 用于登录的 BrowserLogin
+        :param cookie_file: cookie 缓存文件，为 None 则只缓存在内存中
+        :param cookie_ttl: cookie 最长使用时间，单位：秒，cookie 自带的过期时间更早时以其为准
+        :param pool_size: 连接池大小
+        :param timeout: 请求超时时间，单位：秒
+        """
+        self.browser = browser
+        self.cookie_file = cookie_file
+        self.cookie_ttl = cookie_ttl
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.logins = 0
+        self._cookies = None
+        self._expires_at = 0
+        self._session = None
+        self._login_lock = asyncio.Lock()
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _valid_cookies(self):
+        if self._cookies is None:
+            self._load_cookies()
+        if self._cookies is not None and self._expires_at > time.time():
+            return self._cookies
+        return None
+
+    def _load_cookies(self):
+        if self.cookie_file is None:
+            return
+        try:
+            with open(self.cookie_file, 'r') as f:
+                data = json.load(f)
+            self._cookies, self._expires_at = data['cookies'], data['expires_at']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def _save_cookies(self):
+        if self.cookie_file is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.cookie_file))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.oa-cookies-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'cookies': self._cookies, 'expires_at': self._expires_at}, f)
+            os.replace(tmp_path, self.cookie_file)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    async def cookies(self, refresh=False):
+        """
+        可用的登录 cookie，{name: value}，没有或者 refresh 为 True 时用浏览器重新登录
+        同一时间只有一个登录，其他调用方等待该次登录的结果
+        """
+        cookies = None if refresh else self._valid_cookies()
+        if cookies is not None:
+            return cookies
+        stale = self._cookies
+        async with self._login_lock:
+            cookies = self._valid_cookies()
+            if cookies is not None and cookies is not stale:
+                return cookies
+            return await self._login()
+
+    async def _login(self):
+        cookies = await self.browser.login()
+        now = time.time()
+        expires = [cookie['expires'] for cookie in cookies if cookie.get('expires', -1) > now]
+        self._cookies = {cookie['name']: cookie['value'] for cookie in cookies}
+        self._expires_at = min(expires + [now + self.cookie_ttl])
+        self.logins += 1
+        try:
+            self._save_cookies()
+        except Exception as e:
+            print('写入 OA cookie 缓存失败:', e)
+        return self._cookies
+
+    async def request(self, method, path, **kwargs):
+        """
+        发送请求，返回响应内容；被跳转到登录页时重新登录后重试一次
+        """
+        cookies = await self.cookies()
+        for retry in (False, True):
+            async with self.session.request(method, OA_URL + path, cookies=cookies, **kwargs) as resp:
+                resp.raise_for_status()
+                text = await resp.text()
+            if retry or not is_login_html(text):
+                return text
+            cookies = await self.cookies(refresh=True)
+
+    async def get_json_data(self, path):
+        """
+        读取页面中 .json-data 元素里的 json
+        """
+        text = JsonDataParser.parse(await self.request('GET', path))
+        return json.loads(text) if text else None
+
+    async def post(self, path, data):
+        """
+        提交表单，返回 json
+        """
+        return json.loads(await self.request('POST', path, data=data))
+
+
+class JsonDataParser(HTMLParser):
+    """
+    提取第一个 class 包含 json-data 的元素的文本
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.depth = 0
+        self.done = False
+        self.text = []
+
+    @classmethod
+    def parse(cls, html):
+        parser = cls()
+        parser.feed(html)
+        parser.close()
+        return ''.join(parser.text) if parser.done or parser.text else None
+
+    VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+    def handle_starttag(self, tag, attrs):
+        if self.done or tag in self.VOID_TAGS:
+            return
+        if self.depth:
+            self.depth += 1
+        elif 'json-data' in (dict(attrs).get('class') or '').split():
+            self.depth = 1
+
+    def handle_endtag(self, tag):
+        if self.depth and not self.done:
+            self.depth -= 1
+            if not self.depth:
+                self.done = True
+
+    def handle_data(self, data):
+        if self.depth and not self.done:
+            self.text.append(data)
+
+
+def is_login_html(html):
+    return 'id="work_id"' in html or "id='work_id'" in html
+
+
+class BookingCache(object):
+    """
+    按日期缓存会议室预订数据，ttl 秒后过期
+    同一日期同时只有一个请求，其他调用方等待该请求的结果；写入后调用 invalidate 使缓存失效
+    """
+
+    def __init__(self, fetch, ttl=30):
+        """
+        构造函数
+        :param fetch: 读取某一天预订数据的协程函数 fetch(date)，返回 None 时不缓存
+        :param ttl: 缓存时间，单位：秒
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+        self._data = {}
+        self._inflight = {}
+        self._generations = {}
+
+    async def get(self, date):
+        cached = self._data.get(date)
+        if cached is not None and cached[1] > time.monotonic():
+            self.hits += 1
+            return cached[0]
+
+        future = self._inflight.get(date)
+        if future is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 发起请求的调用方被取消时重新请求，自己被取消时继续抛出
+                if not future.cancelled():
+                    raise
+                return await self.get(date)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[date] = future
+        generation = self._generations.get(date, 0)
+        try:
+            data = await self.fetch(date)
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他调用方等待时避免 Future exception was never retrieved
+            future.exception()
+            raise
+        else:
+            future.set_result(data)
+            # 请求期间有写入时结果可能已过时，只返回不缓存
+            if data is not None and self._generations.get(date, 0) == generation:
+                self._data[date] = (data, time.monotonic() + self.ttl)
+            return data
+        finally:
+            # 请求被取消时 future 没有结果，取消它，等待中的调用方重新请求，不会一直阻塞
+            if not future.done():
+                future.cancel()
+            if self._inflight.get(date) is future:
+                del self._inflight[date]
+            self._expire()
+
+    def invalidate(self, date):
+        """
+        使某一天的缓存失效，进行中的请求结果也不再缓存
+        """
+        self.invalidations += 1
+        self._data.pop(date, None)
+        self._inflight.pop(date, None)
+        self._generations[date] = self._generations.get(date, 0) + 1
+
+    def _expire(self):
+        now = time.monotonic()
+        for date in [date for date, (data, expires_at) in self._data.items() if expires_at <= now]:
+            del self._data[date]
+
+    def info(self):
+        total = self.hits + self.misses + self.coalesced
+        return {
+            'dates': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'invalidations': self.invalidations,
+            'hit_rate': round((self.hits + self.coalesced) / total, 3) if total else 0,
+        }
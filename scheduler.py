@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+"""
+后台任务调度
+"""
+
+import asyncio
+import time
+import traceback
+from collections import deque
+
+
+class WorkQueue(object):
+    """
+    有界的异步工作队列，由固定数量的 worker 协程消费
+    """
+
+    def __init__(self, handler, workers=4, maxsize=1000):
+        """
+        构造函数
+        :param handler: 处理单个任务的协程函数
+        :param workers: worker 数量
+        :param maxsize: 队列最大长度，超出时 put 返回 False
+        """
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._queue = None
+        self._tasks = []
+
+    @property
+    def depth(self):
+        """
+        当前排队中的任务数
+        """
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        """
+        启动 worker，需要在事件循环中调用
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        for i in range(self.workers - len(self._tasks)):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    def put(self, item):
+        """
+        任务入队，不等待
+        :return: 是否入队成功
+        """
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def put_wait(self, item, timeout):
+        """
+        任务入队，队列满时最多等待 timeout 秒
+        :return: 是否入队成功，失败时计入 dropped
+        """
+        if self.put(item):
+            return True
+        try:
+            await asyncio.wait_for(self._queue.put(item), timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            return False
+
+    async def stop(self, timeout=10):
+        """
+        等待队列处理完毕（最多 timeout 秒）后停止 worker
+        """
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                print('工作队列未处理完，剩余:', self.depth)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            try:
+                await self.handler(item)
+            except Exception as e:
+                print(e)
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    def info(self):
+        return {
+            'depth': self.depth,
+            'dropped': self.dropped,
+        }
+
+
+class UserScheduler(object):
+    """
+    按用户排队的调度器：同一用户的任务按顺序逐个处理，不同用户并行处理，总并发不超过 concurrency
+    有任务的用户轮流处理，每次只处理一个任务后排到队尾，避免一个用户的大量任务占满并发
+    """
+
+    def __init__(self, handler, concurrency=8, maxsize=20, max_total=1000, window=1000):
+        """
+        构造函数
+        :param handler: 处理单个任务的协程函数
+        :param concurrency: 同时处理的任务数上限
+        :param maxsize: 单个用户排队任务数上限，超出时 put 返回 False
+        :param max_total: 所有用户排队任务总数上限，超出时 put 返回 False，为 None 或 0 则不限制
+        :param window: 统计排队等待时间分位数的最近任务数
+        """
+        self.handler = handler
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self.max_total = max_total
+        self.processed = 0
+        self.rejected = 0
+        self.wait_total = 0
+        self.wait_max = 0
+        self._waits = deque(maxlen=window)
+        self._queues = {}
+        self._depth = 0
+        self._running = set()
+        self._ready = None
+        self._tasks = []
+
+    @property
+    def depth(self):
+        """
+        当前排队中的任务数
+        """
+        return self._depth
+
+    @property
+    def full(self):
+        """
+        排队任务总数是否已达上限
+        """
+        return bool(self.max_total) and self._depth >= self.max_total
+
+    def start(self):
+        """
+        启动 worker，需要在事件循环中调用
+        """
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+        for i in range(self.concurrency - len(self._tasks)):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    def put(self, user, item):
+        """
+        任务进入用户队列，不等待
+        :return: 是否入队成功
+        """
+        queue = self._queues.get(user)
+        if self.full or (queue is not None and len(queue) >= self.maxsize):
+            self.rejected += 1
+            return False
+        if queue is None:
+            queue = self._queues[user] = deque()
+        queue.append((item, time.monotonic()))
+        self._depth += 1
+        if len(queue) == 1 and user not in self._running:
+            self._ready.put_nowait(user)
+        return True
+
+    async def stop(self, timeout=10):
+        """
+        等待队列处理完毕（最多 timeout 秒）后停止 worker
+        """
+        async def drain():
+            while self._queues or self._running:
+                await asyncio.sleep(0.1)
+        try:
+            await asyncio.wait_for(drain(), timeout)
+        except asyncio.TimeoutError:
+            print('用户队列未处理完，剩余:', self.depth)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            user = await self._ready.get()
+            queue = self._queues[user]
+            item, enqueued = queue.popleft()
+            self._depth -= 1
+            self._record_wait(time.monotonic() - enqueued)
+            self._running.add(user)
+            try:
+                await self.handler(item)
+            except Exception as e:
+                print(e)
+                traceback.print_exc()
+            finally:
+                self._running.discard(user)
+                self.processed += 1
+                if queue:
+                    self._ready.put_nowait(user)
+                else:
+                    del self._queues[user]
+
+    def _record_wait(self, wait):
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self._waits.append(wait)
+
+    def info(self):
+        """
+        统计信息，等待时间单位：秒
+        """
+        waits = sorted(self._waits)
+        percentile = lambda p: round(waits[min(len(waits) - 1, int(len(waits) * p))], 3) if waits else 0
+        started = len(self._running) + self.processed
+        return {
+            'depth': self.depth,
+            'users': len(self._queues),
+            'running': len(self._running),
+            'processed': self.processed,
+            'rejected': self.rejected,
+            'wait_avg': round(self.wait_total / started, 3) if started else 0,
+            'wait_p50': percentile(0.5),
+            'wait_p95': percentile(0.95),
+            'wait_max': round(self.wait_max, 3),
+        }
+
+
+class MessageCoalescer(object):
+    """
+    按 key 合并短时间内连续到达的任务：最后一个任务之后 window 秒内没有新任务时，把积攒的任务合并后转发
+    """
+
+    def __init__(self, forward, merge, window, max_items=10):
+        """
+        构造函数
+        :param forward: 转发合并结果的协程函数 forward(item)
+        :param merge: 合并任务列表的函数 merge(items)，只有一个任务时不调用
+        :param window: 等待后续任务的时间，单位：秒
+        :param max_items: 积攒到多少个任务时不再等待，立即转发
+        """
+        self.forward = forward
+        self.merge = merge
+        self.window = window
+        self.max_items = max_items
+        self.received = 0
+        self.forwarded = 0
+        self._pending = {}
+        self._tasks = set()
+        self._forwarding = {}
+
+    def put(self, key, item):
+        """
+        任务入队，不等待
+        """
+        self.received += 1
+        items, timer = self._pending.get(key, ([], None))
+        if timer is not None:
+            timer.cancel()
+        items.append(item)
+        if len(items) >= self.max_items:
+            self._pending[key] = (items, None)
+            self.flush(key)
+        else:
+            self._pending[key] = (items, asyncio.get_running_loop().call_later(self.window, self.flush, key))
+
+    def flush(self, key):
+        """
+        立即转发 key 积攒的任务，不等待转发完成
+        """
+        item = self._take(key)
+        if item is None:
+            return
+        task = asyncio.ensure_future(self._forward(item))
+        self._tasks.add(task)
+        self._forwarding[key] = task
+
+        def done(task):
+            self._tasks.discard(task)
+            if self._forwarding.get(key) is task:
+                del self._forwarding[key]
+        task.add_done_callback(done)
+
+    async def drain(self, key):
+        """
+        转发 key 积攒的任务并等待转发完成，之后转发的任务保证排在它们后面
+        """
+        task = self._forwarding.get(key)
+        if task is not None:
+            await asyncio.gather(asyncio.shield(task), return_exceptions=True)
+        item = self._take(key)
+        if item is not None:
+            await self._forward(item)
+
+    def _take(self, key):
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return None
+        items, timer = pending
+        if timer is not None:
+            timer.cancel()
+        self.forwarded += 1
+        return items[0] if len(items) == 1 else self.merge(items)
+
+    async def _forward(self, item):
+        try:
+            await self.forward(item)
+        except Exception as e:
+            print(e)
+            traceback.print_exc()
+
+    async def stop(self):
+        """
+        转发所有积攒的任务
+        """
+        for key in list(self._pending):
+            self.flush(key)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def info(self):
+        return {
+            'pending': sum(len(items) for items, timer in self._pending.values()),
+            'received': self.received,
+            'forwarded': self.forwarded,
+        }
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""
+用户会话存储
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionBackend(object):
+    """
+    会话持久化接口，会话状态为可 JSON 序列化的 dict，必须包含 createtime
+    """
+
+    def load(self, user):
+        """
+        读取会话状态，不存在返回 None
+        """
+        raise NotImplementedError
+
+    def save_many(self, states):
+        """
+        批量写入会话状态
+        :param states: {user: state}
+        """
+        raise NotImplementedError
+
+    def delete(self, user):
+        raise NotImplementedError
+
+    def delete_expired(self, before):
+        """
+        删除 createtime 早于 before 的会话
+        :return: 删除的会话数
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(SessionBackend):
+    """
+    进程内存储，状态序列化为 JSON 保存，重启后丢失
+    """
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def load(self, user):
+        data = self._states.get(user)
+        return json.loads(data) if data is not None else None
+
+    def save_many(self, states):
+        with self._lock:
+            for user, state in states.items():
+                self._states[user] = json.dumps(state, ensure_ascii=False)
+
+    def delete(self, user):
+        with self._lock:
+            self._states.pop(user, None)
+
+    def delete_expired(self, before):
+        with self._lock:
+            expired = [user for user, data in self._states.items() if json.loads(data)['createtime'] < before]
+            for user in expired:
+                del self._states[user]
+        return len(expired)
+
+
+class SQLiteBackend(SessionBackend):
+    """
+    SQLite 存储，开启 WAL 模式，多个进程可以共用同一个数据库文件
+    """
+
+    def __init__(self, path, timeout=5):
+        """
+        构造函数
+        :param path: 数据库文件路径
+        :param timeout: 等待其他进程释放写锁的时间，单位：秒
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                           'user TEXT PRIMARY KEY, state TEXT NOT NULL, createtime REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS sessions_createtime ON sessions (createtime)')
+        # 读取单独使用一个连接：WAL 模式下读不等待写，线程池中批量写回时事件循环里的读取不会被阻塞
+        self._read_lock = threading.Lock()
+        self._read_conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def load(self, user):
+        with self._read_lock:
+            row = self._read_conn.execute('SELECT state FROM sessions WHERE user = ?', (str(user),)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save_many(self, states):
+        rows = [(str(user), json.dumps(state, ensure_ascii=False), state['createtime'])
+                for user, state in states.items()]
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.executemany('INSERT OR REPLACE INTO sessions (user, state, createtime) VALUES (?, ?, ?)', rows)
+
+    def delete(self, user):
+        with self._lock:
+            self._conn.execute('DELETE FROM sessions WHERE user = ?', (str(user),))
+
+    def delete_expired(self, before):
+        with self._lock:
+            return self._conn.execute('DELETE FROM sessions WHERE createtime < ?', (before,)).rowcount
+
+    def close(self):
+        with self._read_lock:
+            self._read_conn.close()
+        with self._lock:
+            self._conn.close()
+
+
+class SessionStore(object):
+    """
+    LRU + TTL 会话存储
+    超过 max_entries 时淘汰最久未使用的会话，后台定时清理超时会话，并按 max_size 控制会话总大小
+    设置 backend 后作为持久化存储前面的热缓存：首次访问时加载会话，修改过的会话由后台批量写回
+    会话需要有 user、createtime 属性，持久化时还需要 dump()、load(state) 方法
+    """
+
+    def __init__(self, factory, ttl, max_entries=None, max_size=None, sizeof=None, backend=None):
+        """
+        构造函数
+        :param factory: 创建会话的函数 factory(user)
+        :param ttl: 会话超时时间，单位：秒，按会话的 createtime（最后一次提问时间）计算
+        :param max_entries: 最多保存的会话数，为 None 或 0 则不限制
+        :param max_size: 所有会话 sizeof 之和的上限，清理时按 LRU 淘汰，为 None 或 0 则不限制
+        :param sizeof: 计算单个会话大小的函数
+        :param backend: 会话持久化存储 SessionBackend，为 None 则只保存在内存中
+        """
+        self.factory = factory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.flushes = 0
+        self._sessions = OrderedDict()
+        # 修改过、还未写回的会话；已淘汰但未写回的会话状态
+        self._dirty = set()
+        self._pending = {}
+        # 正在写回的会话状态，写入完成前 backend 中还是旧状态
+        self._flushing = {}
+        self._sweeper = None
+        self._flusher = None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, user):
+        return user in self._sessions
+
+    def _expired(self, createtime, now):
+        return now - createtime > self.ttl
+
+    def get(self, user):
+        """
+        获取用户会话，不存在或者已超时则新建
+        """
+        now = time.time()
+        session = self._sessions.get(user)
+        if session is not None:
+            if not self._expired(session.createtime, now):
+                self._sessions.move_to_end(user)
+                self.hits += 1
+                return session
+            self.expirations += 1
+            self.remove(user)
+
+        session = self._load(user, now)
+        if session is None:
+            self.misses += 1
+            print('创建用户:', user)
+            session = self.factory(user)
+        self._sessions[user] = session
+        while self.max_entries and len(self._sessions) > self.max_entries:
+            self._evict()
+        return session
+
+    def _load(self, user, now):
+        if self.backend is None:
+            return None
+        state = self._pending.pop(user, None)
+        unflushed = state is not None
+        if state is None:
+            state = self._flushing.get(user)
+        if state is None:
+            try:
+                state = self.backend.load(user)
+            except Exception as e:
+                print('读取会话失败:', user, e)
+        if state is None or self._expired(state['createtime'], now):
+            return None
+        session = self.factory(user)
+        session.load(state)
+        if unflushed:
+            self._dirty.add(user)
+        self.loads += 1
+        return session
+
+    def mark_dirty(self, session):
+        """
+        标记会话已修改，由后台批量写回；会话已被淘汰时立即保存其状态等待写回
+        """
+        if self.backend is None:
+            return
+        if self._sessions.get(session.user) is session:
+            self._dirty.add(session.user)
+        else:
+            self._pending[session.user] = session.dump()
+
+    def remove(self, user):
+        """
+        删除用户会话
+        """
+        self._dirty.discard(user)
+        self._pending.pop(user, None)
+        return self._sessions.pop(user, None)
+
+    def _evict(self):
+        user, session = self._sessions.popitem(last=False)
+        if user in self._dirty:
+            self._dirty.discard(user)
+            self._pending[user] = session.dump()
+        self.evictions += 1
+        return user, session
+
+    def sweep(self):
+        """
+        清理超时会话，并按 LRU 淘汰到 max_size 以内
+        :return: 清理的会话数
+        """
+        now = time.time()
+        expired = [user for user, session in self._sessions.items() if self._expired(session.createtime, now)]
+        for user in expired:
+            self.remove(user)
+        self.expirations += len(expired)
+
+        evicted = 0
+        if self.max_size and self.sizeof is not None:
+            size = sum(self.sizeof(session) for session in self._sessions.values())
+            while size > self.max_size and len(self._sessions) > 1:
+                user, session = self._evict()
+                size -= self.sizeof(session)
+                evicted += 1
+        return len(expired) + evicted
+
+    async def _run_sweeper(self, interval):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = self.sweep()
+                if removed:
+                    print('清理会话:', removed, self.info())
+                if self.backend is not None:
+                    await loop.run_in_executor(None, self.backend.delete_expired, time.time() - self.ttl)
+            except Exception as e:
+                print('清理会话失败:', e)
+
+    def start_sweeper(self, interval=60):
+        """
+        启动后台清理任务，需要在事件循环中调用
+        """
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._run_sweeper(interval))
+
+    async def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    async def flush(self):
+        """
+        把修改过的会话批量写回 backend，写入在线程池中执行
+        :return: 写回的会话数
+        """
+        if self.backend is None or not (self._dirty or self._pending):
+            return 0
+        states = self._pending
+        self._pending = {}
+        for user in self._dirty:
+            states[user] = self._sessions[user].dump()
+        self._dirty = set()
+
+        self._flushing = states
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.backend.save_many, states)
+        except Exception:
+            # 写入失败的状态放回，下次重试，期间更新过的会话以新状态为准
+            for user, state in states.items():
+                if user not in self._dirty and user not in self._sessions:
+                    self._pending.setdefault(user, state)
+                elif user not in self._dirty:
+                    self._dirty.add(user)
+            raise
+        finally:
+            self._flushing = {}
+        self.flushes += 1
+        return len(states)
+
+    async def _run_flusher(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print('写回会话失败:', e)
+
+    def start_flusher(self, interval=1):
+        """
+        启动后台写回任务，需要在事件循环中调用
+        """
+        if self.backend is not None and self._flusher is None:
+            self._flusher = asyncio.create_task(self._run_flusher(interval))
+
+    async def close(self):
+        """
+        停止后台任务，写回所有修改过的会话并关闭 backend
+        """
+        await self.stop_sweeper()
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        if self.backend is not None:
+            try:
+                await self.flush()
+            finally:
+                self.backend.close()
+
+    def info(self):
+        """
+        统计信息
+        """
+        info = {
+            'size': len(self._sessions),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+        if self.sizeof is not None:
+            info['total_size'] = sum(self.sizeof(session) for session in self._sessions.values())
+        if self.backend is not None:
+            info.update(loads=self.loads, flushes=self.flushes,
+                        unflushed=len(self._dirty) + len(self._pending))
+        return info
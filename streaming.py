@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""
+流式回复：把 openai stream=True 的增量内容按句子、段落分段发送
+"""
+
+import re
+import time
+
+# 段落、句子结束的位置
+PARAGRAPH_END = re.compile(r'\n\s*\n')
+SENTENCE_END = re.compile(r'[。！？；!?;]["”’)）]*|[.](?=\s)|\n')
+
+
+class SentenceBuffer(object):
+    """
+    积攒增量文本，在段落或句子结束处切分出可以发送的片段
+    代码块（```）未闭合时不在句子处切分，超过 max_chars 时强制切分
+    """
+
+    def __init__(self, min_chars=20, max_chars=800, max_delay=2.0):
+        """
+        构造函数
+        :param min_chars: 积攒到这么多字后才在句子结束处切分，段落结束处不受限制
+        :param max_chars: 积攒到这么多字后不论在哪都切分
+        :param max_delay: 距离上一次切分超过这么多秒后，有句子结束就切分，没有则全部发出
+        """
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self.text = ''
+        self.last_flush = time.monotonic()
+
+    def feed(self, text):
+        """
+        追加增量文本
+        :return: 可以发送的片段列表
+        """
+        self.text += text
+        chunks = []
+        while self.text:
+            end = self._split_point()
+            if end is None:
+                break
+            chunk, self.text = self.text[:end], self.text[end:]
+            if chunk.strip():
+                chunks.append(chunk.strip())
+                self.last_flush = time.monotonic()
+        return chunks
+
+    def flush(self):
+        """
+        取出剩余的全部文本
+        """
+        text, self.text = self.text.strip(), ''
+        self.last_flush = time.monotonic()
+        return text
+
+    def _split_point(self):
+        text = self.text
+        if len(text) >= self.max_chars:
+            return self._last_end(text[:self.max_chars], self.max_chars // 2) or self.max_chars
+        in_code = text.count('```') % 2 == 1
+
+        paragraph = None
+        for match in PARAGRAPH_END.finditer(text):
+            if text[:match.start()].count('```') % 2 == 0:
+                paragraph = match.end()
+        if paragraph is not None and text[:paragraph].strip():
+            return paragraph
+        if in_code:
+            return None
+
+        end = self._last_end(text, self.min_chars)
+        if end is not None:
+            return end
+        if time.monotonic() - self.last_flush >= self.max_delay:
+            return self._last_end(text, 1) or len(text)
+        return None
+
+    @staticmethod
+    def _last_end(text, min_pos):
+        """
+        min_pos 之后最后一个句子结束的位置
+        """
+        end = None
+        for match in SENTENCE_END.finditer(text):
+            if match.end() >= min_pos and text[:match.start()].count('```') % 2 == 0:
+                end = match.end()
+        return end
+
+
+async def collect_stream(response, send, buffer):
+    """
+    读取 openai 流式回复，文本内容边接收边分段发送
+    :param response: ChatCompletion.acreate(stream=True) 的返回值
+    :param send: 发送一段文本的协程函数
+    :param buffer: SentenceBuffer
+    :return: 拼接后的完整消息 {'role', 'content', 'function_call'}，可以直接加入会话历史
+    """
+    content = []
+    function_call = None
+    async for chunk in response:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].get('delta') or {}
+        if delta.get('function_call'):
+            if function_call is None:
+                function_call = {'name': '', 'arguments': ''}
+            function_call['name'] += delta['function_call'].get('name') or ''
+            function_call['arguments'] += delta['function_call'].get('arguments') or ''
+        text = delta.get('content')
+        if text:
+            content.append(text)
+            for piece in buffer.feed(text):
+                await send(piece)
+
+    rest = buffer.flush()
+    if rest:
+        await send(rest)
+
+    message = {'role': 'assistant', 'content': ''.join(content) or None}
+    if function_call is not None:
+        message['function_call'] = function_call
+    return message